@@ -0,0 +1,278 @@
+import re
+import json
+import time
+import random
+import struct
+import asyncio
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+# Local stand-ins for every upstream the bot talks to, served by one aiohttp app:
+#   /api/                         tikwm-style JSON API
+#   /video/media/{variant}/{id}   tikwm media (synthetic MP4, Range aware)
+#   /reel_by_shortcode            RapidAPI-style reel endpoint
+#   /media/{kind}/{id}.mp4        plain media host (Instagram CDN, yt-dlp generic extractor)
+#   /img/{id}/{n}.jpg, /music/{id}.mp3
+#   /bot{token}/{method}          Bot API that accepts uploads
+
+# Handlers report failures by editing their "⏳ ..." status to one of these.
+ERROR_PREFIXES = ("❌", "⚠️")
+
+
+def _box(kind: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def _track(handler: bytes, fourcc: bytes, width: int = 0, height: int = 0) -> bytes:
+    tkhd = _box(b"tkhd", bytes(76) + struct.pack(">II", width << 16, height << 16))
+    hdlr = _box(b"hdlr", bytes(8) + handler + bytes(13))
+    stsd = _box(b"stsd", struct.pack(">II", 0, 1) + struct.pack(">I4s", 16, fourcc) + bytes(8))
+    return _box(b"trak", tkhd + _box(b"mdia", hdlr + _box(b"minf", _box(b"stbl", stsd))))
+
+
+def synthetic_mp4(size: int, width: int = 720, height: int = 1280, duration: int = 15) -> bytes:
+    """
+    MP4 потрібного розміру з валідним `moov` (розміри, тривалість, h264/aac) і порожнім `mdat`.
+    """
+    mvhd = _box(b"mvhd", struct.pack(">4xIIII", 0, 0, 1000, duration * 1000) + bytes(80))
+    head = (
+        _box(b"ftyp", b"isom" + bytes(4) + b"isommp42")
+        + _box(b"moov", mvhd + _track(b"vide", b"avc1", width, height) + _track(b"soun", b"mp4a"))
+    )
+    padding = max(0, size - len(head) - 8)
+    return head + struct.pack(">I4s", 8 + padding, b"mdat") + bytes(padding)
+
+
+class FakeUpstreams:
+    def __init__(self, video_bytes: int = 8 * 1024 * 1024, image_bytes: int = 200 * 1024, slides: int = 12,
+                 latency: float = 0.0, flood_rate: float = 0.0, seed: int = 0):
+        self.video_bytes = video_bytes
+        self.image_bytes = image_bytes
+        self.slides = slides
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.random = random.Random(seed)
+        self.base_url = ""
+        self.calls: Counter[str] = Counter()
+        self.bytes_served = 0
+        self.bytes_uploaded = 0
+        # Per chat: captioned media replies (video, photo, first item of a group) and error edits.
+        self.delivered: Counter[int] = Counter()
+        self.errors: defaultdict[int, list[str]] = defaultdict(list)
+        # Slideshow photos received, and photo messages whose slides were not consecutive
+        # (or a captioned one that did not start at slide 1).
+        self.slides_sent = 0
+        self.slides_misordered = 0
+        self._media: dict[int, bytes] = {}
+        self._message_id = 0
+        self._runner: web.AppRunner | None = None
+
+    # ------------------------- LIFECYCLE -------------------------
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application(client_max_size=4 * 1024 ** 3)
+        app.router.add_get("/api/", self._tikwm_api)
+        app.router.add_get("/video/media/{variant}/{media_id}.mp4", self._tikwm_media)
+        app.router.add_get("/reel_by_shortcode", self._rapidapi_reel)
+        app.router.add_get("/media/{kind}/{media_id}.mp4", self._plain_media)
+        app.router.add_get("/img/{media_id}/{index}.jpg", self._image)
+        app.router.add_get("/music/{media_id}.mp3", self._music)
+        app.router.add_post("/bot{token}/{method}", self._bot_api)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        bound_port = self._runner.addresses[0][1]
+        self.base_url = f"http://{host}:{bound_port}"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    def env(self) -> dict[str, str]:
+        """
+        Змінні середовища, що спрямовують бота на ці сервери.
+        """
+        return {
+            "TIKWM_API_URL": f"{self.base_url}/api/",
+            "TIKWM_MEDIA_URL": f"{self.base_url}/video/media/{{variant}}/{{video_id}}.mp4",
+            "RAPIDAPI_URL": f"{self.base_url}/reel_by_shortcode",
+            "RAPIDAPI_KEY": "bench",
+            "RAPIDAPI_HOST": "bench",
+            # Only the faked backends; the fallbacks would go to the real sites.
+            "TIKTOK_BACKENDS": "tikwm",
+            "INSTAGRAM_BACKENDS": "rapidapi",
+        }
+
+    def youtube_media_url(self, video_id: str) -> str:
+        return f"{self.base_url}/media/youtube/{video_id}.mp4"
+
+    # ------------------------- MEDIA -------------------------
+
+    def _video(self, size: int) -> bytes:
+        data = self._media.get(size)
+        if data is None:
+            data = self._media[size] = synthetic_mp4(size)
+        return data
+
+    async def _delay(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _ranged(self, request: web.Request, data: bytes, content_type: str) -> web.Response:
+        match = re.match(r"bytes=(\d+)-(\d*)", request.headers.get("Range", ""))
+        if not match:
+            self.bytes_served += len(data) if request.method != "HEAD" else 0
+            return web.Response(body=data, content_type=content_type)
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else len(data) - 1, len(data) - 1)
+        body = data[start:end + 1]
+        self.bytes_served += len(body)
+        return web.Response(
+            status=206, body=body, content_type=content_type,
+            headers={"Content-Range": f"bytes {start}-{end}/{len(data)}", "Accept-Ranges": "bytes"},
+        )
+
+    async def _tikwm_api(self, request: web.Request) -> web.Response:
+        self.calls["tikwm:api"] += 1
+        await self._delay()
+        url = request.query.get("url", "")
+        match = re.search(r"/(video|photo)/(\d+)", url)
+        if not match:
+            return web.json_response({"code": -1, "msg": "Url parsing is failed!"})
+        kind, media_id = match.groups()
+        data = {
+            "id": media_id,
+            "duration": 15,
+            "size": self.video_bytes,
+            "hd_size": self.video_bytes * 2,
+            "music": f"{self.base_url}/music/{media_id}.mp3",
+            "music_info": {"title": "bench", "play": f"{self.base_url}/music/{media_id}.mp3"},
+        }
+        if kind == "photo":
+            data["images"] = [f"{self.base_url}/img/{media_id}/{n}.jpg" for n in range(self.slides)]
+        return web.json_response({"code": 0, "data": data})
+
+    async def _tikwm_media(self, request: web.Request) -> web.Response:
+        self.calls["tikwm:media"] += 1
+        await self._delay()
+        size = self.video_bytes * (2 if request.match_info["variant"] == "hdplay" else 1)
+        return self._ranged(request, self._video(size), "video/mp4")
+
+    async def _rapidapi_reel(self, request: web.Request) -> web.Response:
+        self.calls["rapidapi:reel"] += 1
+        await self._delay()
+        shortcode = request.query.get("shortcode", "")
+        return web.json_response({
+            "video_versions": [
+                {"url": f"{self.base_url}/media/instagram/{shortcode}.mp4", "width": 720, "height": 1280},
+            ],
+            "video_duration": 15,
+        })
+
+    async def _plain_media(self, request: web.Request) -> web.Response:
+        self.calls[f"media:{request.match_info['kind']}"] += 1
+        await self._delay()
+        return self._ranged(request, self._video(self.video_bytes), "video/mp4")
+
+    async def _image(self, request: web.Request) -> web.Response:
+        self.calls["tikwm:image"] += 1
+        await self._delay()
+        self.bytes_served += self.image_bytes
+        return web.Response(body=bytes(self.image_bytes), content_type="image/jpeg")
+
+    async def _music(self, request: web.Request) -> web.Response:
+        self.calls["tikwm:music"] += 1
+        await self._delay()
+        return self._ranged(request, bytes(512 * 1024), "audio/mpeg")
+
+    # ------------------------- BOT API -------------------------
+
+    def _message(self, chat_id, **fields) -> dict:
+        self._message_id += 1
+        chat_id = int(chat_id)
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            **fields,
+        }
+
+    def _record_outcome(self, method: str, chat_id: int, form):
+        if method == "editmessagetext":
+            text = form.get("text", "")
+            if text.startswith(ERROR_PREFIXES):
+                self.errors[chat_id].append(text)
+        elif method in ("sendvideo", "sendphoto") and form.get("caption"):
+            self.delivered[chat_id] += 1
+        elif method == "sendmediagroup":
+            media = json.loads(form.get("media", "[]"))
+            if media and media[0].get("caption"):
+                self.delivered[chat_id] += 1
+
+        if method == "sendphoto":
+            self._record_slides([form.get("photo")], bool(form.get("caption")))
+        elif method == "sendmediagroup":
+            media = json.loads(form.get("media", "[]"))
+            attached = [form.get(item["media"].removeprefix("attach://")) for item in media]
+            self._record_slides(attached, bool(media and media[0].get("caption")))
+
+    def _record_slides(self, files: list, captioned: bool):
+        numbers = []
+        for file in files:
+            match = re.fullmatch(r"slide_(\d+)\.jpg", getattr(file, "filename", "") or "")
+            if match:
+                numbers.append(int(match.group(1)))
+        if not numbers:
+            return
+        self.slides_sent += len(numbers)
+        if numbers != list(range(numbers[0], numbers[0] + len(numbers))) or (captioned and numbers[0] != 1):
+            self.slides_misordered += 1
+
+    async def _bot_api(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        self.calls[f"bot:{method}"] += 1
+        form = await request.post()
+        # aiogram uploads with chunked encoding, so there is no Content-Length to count.
+        for value in form.values():
+            if isinstance(value, web.FileField):
+                value.file.seek(0, 2)
+                self.bytes_uploaded += value.file.tell()
+        await self._delay()
+
+        if self.flood_rate and method.startswith("send") and self.random.random() < self.flood_rate:
+            self.calls["bot:429"] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            })
+
+        chat_id = form.get("chat_id", 1)
+        n = self._message_id + 1
+        self._record_outcome(method, int(chat_id), form)
+        if method == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method in ("sendmessage", "editmessagetext"):
+            result = self._message(chat_id, text=form.get("text", ""))
+        elif method == "sendvideo":
+            result = self._message(chat_id, video={
+                "file_id": f"video-{n}", "file_unique_id": f"v{n}", "width": 720, "height": 1280, "duration": 15,
+            })
+        elif method == "sendaudio":
+            result = self._message(chat_id, audio={"file_id": f"audio-{n}", "file_unique_id": f"a{n}", "duration": 15})
+        elif method == "sendphoto":
+            result = self._message(chat_id, photo=[{"file_id": f"photo-{n}", "file_unique_id": f"p{n}",
+                                                    "width": 1080, "height": 1920}])
+        elif method == "sendmediagroup":
+            media = json.loads(form.get("media", "[]"))
+            result = [
+                self._message(chat_id, media_group_id=str(n), photo=[{
+                    "file_id": f"photo-{n}-{i}", "file_unique_id": f"p{n}-{i}", "width": 1080, "height": 1920,
+                }])
+                for i in range(len(media))
+            ]
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
@@ -0,0 +1,273 @@
+"""
+Офлайн-бенчмарк: проганяє синтетичні апдейти через справжній Dispatcher і хендлери,
+а TikTok/Instagram/YouTube та Bot API підміняє локальними серверами (bench/fakes.py).
+
+    python -m bench.run --updates 200 --concurrency 32 --mix tiktok=4,slideshow=1,instagram=3,youtube=2
+"""
+import os
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+import resource
+import tempfile
+import itertools
+from collections import Counter, defaultdict
+
+from bench.fakes import FakeUpstreams
+
+MB = 1024 * 1024
+KINDS = ("tiktok", "slideshow", "instagram", "youtube")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline DownloaderBot benchmark")
+    parser.add_argument("--updates", type=int, default=200, help="messages to feed")
+    parser.add_argument("--concurrency", type=int, default=32, help="updates processed at once")
+    parser.add_argument("--users", type=int, default=50, help="distinct senders")
+    parser.add_argument("--mix", default="tiktok=4,slideshow=1,instagram=3,youtube=2",
+                        help="relative weight of each link kind")
+    parser.add_argument("--distinct", type=int, default=0,
+                        help="distinct media per kind (0 = every update is a new post)")
+    parser.add_argument("--video-mb", type=float, default=8, help="size of each synthetic video")
+    parser.add_argument("--slides", type=int, default=12, help="images per slideshow")
+    parser.add_argument("--latency-ms", type=float, default=0, help="added to every fake upstream response")
+    parser.add_argument("--flood-rate", type=float, default=0, help="share of send* calls answered with 429")
+    parser.add_argument("--stream", choices=("0", "1"), default="1", help="STREAM_UPLOADS for the run")
+    return parser.parse_args(argv)
+
+
+def parse_mix(mix: str) -> list[str]:
+    weights = {}
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in KINDS:
+            raise SystemExit(f"Unknown kind in --mix: {kind!r} (expected one of {', '.join(KINDS)})")
+        weights[kind.strip()] = int(weight or 1)
+    return [kind for kind, weight in weights.items() for _ in range(weight)]
+
+
+def media_url(kind: str, n: int) -> str:
+    if kind == "tiktok":
+        return f"https://www.tiktok.com/@bench/video/{7_000_000_000_000_000_000 + n}"
+    if kind == "slideshow":
+        return f"https://www.tiktok.com/@bench/photo/{7_100_000_000_000_000_000 + n}"
+    if kind == "instagram":
+        return f"https://www.instagram.com/reel/Bench{n}/"
+    # YouTube ids are exactly 11 characters
+    return f"https://www.youtube.com/watch?v=bench{n:06d}"
+
+
+def make_update(update_id: int, user_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+        },
+    }
+
+
+class Sampler:
+    """
+    Раз на `interval` секунд знімає RSS, кількість відкритих дескрипторів і зайняте місце під `root`.
+    """
+
+    def __init__(self, root: str, interval: float = 0.1):
+        self.root = root
+        self.interval = interval
+        self.max_fds = 0
+        self.max_disk = 0
+        self._task: asyncio.Task | None = None
+
+    def _sample(self):
+        try:
+            self.max_fds = max(self.max_fds, len(os.listdir("/proc/self/fd")))
+        except OSError:
+            pass
+        used = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                try:
+                    # Allocated blocks, so preallocated .part files count at full size.
+                    used += os.stat(os.path.join(dirpath, name)).st_blocks * 512
+                except OSError:
+                    pass
+        self.max_disk = max(self.max_disk, used)
+
+    async def _run(self):
+        while True:
+            self._sample()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._sample()
+
+
+def _fmt(seconds: float | None) -> str:
+    return "-" if seconds is None else f"{seconds * 1000:.0f}ms"
+
+
+def _quantile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def count_failures(expected: Counter, upstreams: FakeUpstreams) -> int:
+    """
+    Апдейти без очікуваної відповіді: хендлери ковтають помилки в статус, тож рахуються
+    чати, де медіа-відповідей менше, ніж апдейтів, або статус змінено на помилку.
+    """
+    return sum(
+        max(expected[chat] - upstreams.delivered[chat], len(upstreams.errors[chat]))
+        for chat in expected
+    )
+
+
+def report(args, elapsed: float, latencies: dict[str, list[float]], failures: int,
+           sampler: Sampler, upstreams: FakeUpstreams):
+    from services import metrics
+
+    total = sum(len(v) for v in latencies.values())
+    print(f"\n== {total} updates in {elapsed:.2f}s: {total / elapsed:.1f} updates/s, "
+          f"{failures} failed, concurrency {args.concurrency}, stream={args.stream}")
+
+    errors = Counter(text for texts in upstreams.errors.values() for text in texts)
+    for text, count in errors.most_common(5):
+        print(f"  {count} x {text}")
+
+    print("\n-- end to end (update fed -> handler returned)")
+    for kind, values in sorted(latencies.items()):
+        print(f"{kind:>10}: n={len(values):<5} p50={_fmt(_quantile(values, 0.5)):>7} "
+              f"p95={_fmt(_quantile(values, 0.95)):>7} p99={_fmt(_quantile(values, 0.99)):>7}")
+
+    print("\n-- stages (services.metrics)")
+    for (stage, platform), row in metrics.percentiles().items():
+        print(f"{stage + '/' + platform:>22}: n={row['n']:<5} p50={_fmt(row['p50']):>7} "
+              f"p95={_fmt(row['p95']):>7} p99={_fmt(row['p99']):>7}")
+
+    # ru_maxrss is KB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print("\n-- resources")
+    print(f"peak RSS: {peak_rss / MB:.1f} MB (includes the fake servers)")
+    print(f"max open fds: {sampler.max_fds}")
+    print(f"workspace disk high-water: {sampler.max_disk / MB:.1f} MB")
+
+    print("\n-- fake upstreams")
+    print(f"served: {upstreams.bytes_served / MB:.1f} MB, uploaded to Bot API: {upstreams.bytes_uploaded / MB:.1f} MB")
+    if upstreams.slides_sent or upstreams.slides_misordered:
+        print(f"slides sent: {upstreams.slides_sent}, out-of-order photo messages: {upstreams.slides_misordered}")
+    for name, count in sorted(upstreams.calls.items()):
+        print(f"{name:>24}: {count}")
+
+
+async def run(args) -> int:
+    workdir = tempfile.mkdtemp(prefix="downloaderbot-bench-")
+    upstreams = FakeUpstreams(
+        video_bytes=int(args.video_mb * MB), slides=args.slides,
+        latency=args.latency_ms / 1000, flood_rate=args.flood_rate,
+    )
+    base_url = await upstreams.start()
+
+    # Configuration is read at import time, so it has to be in place before the bot is imported.
+    os.environ.update(upstreams.env())
+    os.environ.update({
+        "BOT_TOKEN": "123456:BENCH",
+        "METRICS_PORT": "0",
+        "WORKSPACE_ROOT": os.path.join(workdir, "workspaces"),
+        "DB_PATH": os.path.join(workdir, "bot.db"),
+        "CALLBACK_PERSIST": "0",
+        "STREAM_UPLOADS": args.stream,
+    })
+    os.makedirs(os.environ["WORKSPACE_ROOT"])
+
+    from aiogram.client.telegram import TelegramAPIServer
+    from services.app import create_app
+    app = create_app()
+    app.bot.session.api = TelegramAPIServer.from_base(base_url)
+
+    app.include_handlers()
+    from handlers import youtube
+    from services.cache import file_cache
+    from services.callbacks import callback_store
+    from services.http import close_clients
+    from services.links import extract_media_id
+    from services.metrics import timed
+    from services.ui import load_bot_identity
+    from services.users import users
+
+    @timed("resolve", "youtube")
+    async def fetch_local_youtube(url: str) -> dict:
+        # yt-dlp's generic extractor against the fake media host instead of youtube.com.
+        local_url = upstreams.youtube_media_url(extract_media_id("youtube", url))
+        loop = asyncio.get_running_loop()
+        with youtube.youtube_dl({"quiet": True, "no_warnings": True}) as ydl:
+            return await loop.run_in_executor(None, lambda: ydl.extract_info(local_url, download=False))
+
+    youtube.fetch_youtube_info = fetch_local_youtube
+    await load_bot_identity(app.bot)
+
+    kinds = parse_mix(args.mix)
+    counters = defaultdict(itertools.count)
+    latencies: dict[str, list[float]] = defaultdict(list)
+    raised = 0
+    expected: Counter[int] = Counter()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    sampler = Sampler(os.environ["WORKSPACE_ROOT"])
+
+    async def feed(update_id: int):
+        nonlocal raised
+        kind = kinds[update_id % len(kinds)]
+        n = next(counters[kind])
+        if args.distinct:
+            n %= args.distinct
+        user_id = 1000 + update_id % args.users
+        expected[user_id] += 1
+        update = make_update(update_id, user_id, media_url(kind, n))
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await app.dp.feed_raw_update(app.bot, update)
+            except Exception as e:
+                raised += 1
+                print(f"update {update_id} ({kind}) failed: {e}", file=sys.stderr)
+            latencies[kind].append(time.perf_counter() - started)
+
+    sampler.start()
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(feed(i) for i in range(1, args.updates + 1)))
+        elapsed = time.perf_counter() - started
+    finally:
+        await sampler.stop()
+        await callback_store.close()
+        await file_cache.close()
+        await users.close()
+        await close_clients()
+        await app.bot.session.close()
+        await upstreams.stop()
+
+    failures = raised + count_failures(expected, upstreams) + upstreams.slides_misordered
+    report(args, elapsed, latencies, failures, sampler, upstreams)
+    shutil.rmtree(workdir, ignore_errors=True)
+    return 1 if failures else 0
+
+
+def cli(argv=None):
+    raise SystemExit(asyncio.run(run(parse_args(argv))))
+
+
+if __name__ == "__main__":
+    cli()
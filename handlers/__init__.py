@@ -1,11 +1,23 @@
 from aiogram import Router
 
-from . import youtube, start, tiktok, instagram, inline
+from services.links import LinkMiddleware
+from services.startup import startup
+from services.users import UserActivityMiddleware
+
+# One at a time so the startup report shows what each handler module costs.
+start, admin, youtube, tiktok, instagram, inline = (
+    startup.import_module(f"{__name__}.{name}")
+    for name in ("start", "admin", "youtube", "tiktok", "instagram", "inline")
+)
 
 router = Router(name=__name__)
+router.message.outer_middleware(UserActivityMiddleware())
+router.callback_query.outer_middleware(UserActivityMiddleware())
+router.message.outer_middleware(LinkMiddleware())
 
 router.include_routers(
     start.router,
+    admin.router,
     youtube.router,
     tiktok.router,
     instagram.router,
@@ -0,0 +1,20 @@
+from aiogram import Router, F
+from aiogram.types import Message
+
+from services import metrics, providers
+from services.app import App
+from services.cache import file_cache
+
+router = Router()
+
+
+@router.message(F.text == "/stats")
+async def stats_handler(message: Message, app: App):
+    if not app.is_admin(message.from_user.id):
+        return
+
+    cache = file_cache.stats()
+    await message.answer(
+        f"📊 Stats\n\n{metrics.summary()}\n\n{providers.summary()}\n\n"
+        f"file_id cache: hits={cache['hits']} misses={cache['misses']} ratio={cache['hit_ratio']}"
+    )
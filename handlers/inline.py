@@ -1,62 +1,145 @@
 import os
 import uuid
+import asyncio
+import logging
 from aiogram import Router, Bot
-from aiogram.types import InlineQuery, InlineQueryResultCachedVideo
-from aiogram.types.input_file import FSInputFile
+from aiogram.types import (
+    InlineQuery, InlineQueryResultCachedVideo, InlineQueryResultArticle, InputTextMessageContent
+)
 from handlers.youtube import download_media
-from handlers.tiktok import download_tiktok
+from handlers.tiktok import download_tiktok, release_download
 from handlers.instagram import download_reel
-from main import bot
+from services.botapi import input_file
+from services.cache import file_cache
+from services.links import Link, classify, expand, expanded
+from services.scheduler import scheduler
+from services.singleflight import downloads
+from services.ui import bot_username, video_caption
+from services.workspace import workspaces
 
 router = Router()
 CHANNEL_ID = os.getenv("CHANNEL_ID")
+# Wait this long after the last keystroke before starting a prefetch.
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", 0.8))
+
+_debounce: dict[int, asyncio.Task] = {}
+_prefetching: set[str] = set()
+_background: set[asyncio.Task] = set()
 
-@router.inline_query()
-async def handle_inline_query(inline_query: InlineQuery, bot: Bot):
-    bot_username = (await bot.get_me()).username
-    url = inline_query.query.strip()
-    file_path = None
 
-    # Визначення типу
+async def prefetch(bot: Bot, platform: str, url: str, cache_key: str, user_id: int, requester: str):
+    """
+    Завантажує відео у фоні, надсилає його в CHANNEL_ID і кешує file_id для наступного запиту.
+    """
+    if platform == "youtube":
+        download = lambda: download_media(url)
+    elif platform == "tiktok":
+        download = lambda: download_tiktok(url)
+    else:
+        download = lambda: download_reel(url)
+    factory = lambda: scheduler.run(platform, user_id, download)
+    if platform == "instagram":
+        cleanup = workspaces.release
+    elif platform == "tiktok":
+        cleanup = release_download
+    else:
+        cleanup = lambda r: workspaces.release(r[0])
+
     try:
-        if "youtube.com" in url or "youtu.be" in url:
-            file_path, error = download_media(url)
-            if error:
-                raise Exception(error)
+        async with downloads.join(cache_key, factory, cleanup=cleanup) as flight:
+            if platform == "instagram":
+                file_path = flight.result
+            else:
+                file_path, content_type, error = flight.result
+                if error:
+                    downloads.forget(cache_key)
+                    raise Exception(error)
+                if platform == "tiktok" and content_type != "video":
+                    raise Exception("Only videos are supported in inline mode")
+
+            async with flight.lock:
+                if not flight.file_id:
+                    # Надсилання в канал
+                    video_message = await bot.send_video(
+                        chat_id=CHANNEL_ID,
+                        video=input_file(file_path),
+                        caption=f"🎬 Request from @{requester}"
+                    )
+                    flight.file_id = video_message.video.file_id
+                    file_cache.put(cache_key, flight.file_id)
+    except Exception as e:
+        logging.error(f"[INLINE PREFETCH ERROR] {url}: {e}")
+    finally:
+        _prefetching.discard(cache_key)
+
+
+def _supported(link: Link) -> bool:
+    return not (link.platform == "instagram" and link.kind not in ("reel", "short"))
 
-        elif "tiktok.com" in url or "vm.tiktok.com" in url or "vt.tiktok.com" in url:
-            file_path, _, error = await download_tiktok(url, type="video")
-            if error:
-                raise Exception(error)
 
-        elif "instagram.com/reel/" in url:
-            file_path = await download_reel(url)
+async def _debounced_prefetch(bot: Bot, link: Link, user_id: int, requester: str):
+    await asyncio.sleep(INLINE_DEBOUNCE)
+    # Short links are expanded here, off the inline answer's path; the result is cached for the next query.
+    link = await expand(link)
+    _debounce.pop(user_id, None)
+    if link.kind == "short" or not _supported(link):
+        return
+    cache_key = link.key("video")
+    if cache_key in _prefetching or file_cache.get(cache_key):
+        return
+    _prefetching.add(cache_key)
+    # A separate task: a newer keystroke cancels the debounce, never a running download.
+    task = asyncio.create_task(prefetch(bot, link.platform, link.url, cache_key, user_id, requester))
+    _background.add(task)
+    task.add_done_callback(_background.discard)
 
-        else:
-            raise Exception("Url is not supported")
 
-        # Надсилання в канал
-        video_message = await bot.send_video(
-            chat_id=CHANNEL_ID,
-            video=FSInputFile(file_path),
-            caption=f"🎬 Request from @{inline_query.from_user.username or inline_query.from_user.id}"
-        )
+@router.inline_query()
+async def handle_inline_query(inline_query: InlineQuery, bot: Bot):
+    user_id = inline_query.from_user.id
+
+    previous = _debounce.pop(user_id, None)
+    if previous:
+        previous.cancel()
 
-        file_id = video_message.video.file_id
+    # classify only: a short link is answered right away and expanded in the debounced prefetch.
+    link = classify(inline_query.query)
+    link = expanded(link) if link else None
+    if not link or not _supported(link):
+        await inline_query.answer([], cache_time=1)
+        return
+
+    try:
+        username = await bot_username(bot)
+        cache_key = link.key("video")
+        file_id = file_cache.get(cache_key) if link.kind != "short" else None
+
+        if file_id:
+            await inline_query.answer([
+                InlineQueryResultCachedVideo(
+                    id=str(uuid.uuid4()),
+                    video_file_id=file_id,
+                    title="📥 Click for send video",
+                    caption=video_caption(username)
+                )
+            ], cache_time=1)
+            return
+
+        if cache_key not in _prefetching:
+            requester = inline_query.from_user.username or user_id
+            _debounce[user_id] = asyncio.create_task(_debounced_prefetch(bot, link, user_id, requester))
 
         await inline_query.answer([
-            InlineQueryResultCachedVideo(
+            InlineQueryResultArticle(
                 id=str(uuid.uuid4()),
-                video_file_id=file_id,
-                title="📥 Click for send video",
-                caption=f"🔗 Download video here 👉 @{bot_username}"
+                title="⏳ Preparing video…",
+                description="Try again in a few seconds",
+                input_message_content=InputTextMessageContent(
+                    message_text=f"⏳ The video is being prepared, try again in a few seconds 👉 @{username}"
+                )
             )
-        ], cache_time=1)
+        ], cache_time=1, is_personal=True)
 
     except Exception as e:
-        print(f"[INLINE ERROR] {e}")
+        logging.error(f"[INLINE ERROR] {e}")
         await inline_query.answer([], switch_pm_text="❌ Error", switch_pm_parameter="start", cache_time=1)
-
-    finally:
-        if file_path and os.path.exists(file_path):
-            os.remove(file_path)
@@ -1,154 +1,306 @@
 import os
-import re
 import uuid
 import asyncio
-import httpx
+import logging
 import aiohttp
 
-from dotenv import load_dotenv
-from aiogram import Router, F
-from aiogram.types import (
-    Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
-)
-from aiogram.types.input_file import FSInputFile
-from moviepy import VideoFileClip
-from main import bot
-
+from aiogram import Bot, Router, F
+from aiogram.types import Message, CallbackQuery
+from services import formats, ytdlp
+from services.botapi import input_file
+from services.cache import file_cache, make_key
+from services.callbacks import callback_store
+from services.links import Link, LinkFilter, classify, extract_media_id
+from services.http import get_session
+from services.ranged import download_file
+from services.metrics import timed, file_size
+from services.providers import NotFound, Provider, backends_from_env, run_blocking
+from services.resolve import MediaTooLarge, cached_resolve, check_limits, fits
+from services.scheduler import scheduler, queue_status
+from services.audio import extract_audio
+from services.singleflight import downloads, DOWNLOAD_LINGER
+from services.streaming import answer_video_streamed
+from services.ui import bot_username, video_caption, audio_caption, mp3_keyboard, finish_status
+from services.workspace import workspaces
 
-load_dotenv()
 
 RAPIDAPI_KEY = os.getenv("RAPIDAPI_KEY")
 RAPIDAPI_HOST = os.getenv("RAPIDAPI_HOST")
+RAPIDAPI_URL = os.getenv(
+    "RAPIDAPI_URL",
+    "https://instagram-scrapper-posts-reels-stories-downloader.p.rapidapi.com/reel_by_shortcode"
+)
 
-DOWNLOADS_FOLDER = "services/downloads"
-os.makedirs(DOWNLOADS_FOLDER, exist_ok=True)
+RAPIDAPI_TIMEOUT = aiohttp.ClientTimeout(total=20, connect=10)
 
 router = Router()
-callback_store = {}
 
 
-async def download_reel(reel_url: str) -> str:
-    shortcode_match = re.search(r"(reel|p)/([a-zA-Z0-9_-]+)", reel_url)
-    if not shortcode_match:
-        raise Exception("❌ Не вдалося витягнути shortcode з URL")
+async def _content_length(url: str) -> int | None:
+    try:
+        async with get_session().head(url, allow_redirects=True, timeout=RAPIDAPI_TIMEOUT) as response:
+            return response.content_length if response.status == 200 else None
+    except Exception as e:
+        logging.debug(f"HEAD {url} failed: {e}")
+        return None
+
+
+async def _reel(versions: list[tuple[str, int | None]], duration: float | None) -> dict:
+    # The sizes come from HEAD since none of the backends report them reliably.
+    urls = list(dict.fromkeys(u for u, _ in versions))
+    heights = dict(versions)
+    sizes = await asyncio.gather(*(_content_length(u) for u in urls))
+    return {"versions": [(u, s, heights[u]) for u, s in zip(urls, sizes)], "duration": duration}
 
-    shortcode = shortcode_match.group(2)
 
-    api_url = "https://instagram-scrapper-posts-reels-stories-downloader.p.rapidapi.com/reel_by_shortcode"
+async def fetch_reel_rapidapi(shortcode: str) -> dict:
+    api_url = RAPIDAPI_URL
     headers = {
         "x-rapidapi-key": RAPIDAPI_KEY,
         "x-rapidapi-host": RAPIDAPI_HOST
     }
     params = {"shortcode": shortcode}
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(api_url, headers=headers, params=params) as response:
-            data = await response.json()
-            print("API response:", data)  # Для логів
+    session = get_session()
+    async with session.get(api_url, headers=headers, params=params, timeout=RAPIDAPI_TIMEOUT) as response:
+        # Quota and upstream errors must count against the backend, not read as "no video".
+        response.raise_for_status()
+        data = await response.json()
+        logging.debug(f"Instagram API response: {data}")
+
+    # Check if we got a valid response
+    if not data:
+        raise Exception("❌ Відповідь API порожня")
+
+    # Get the best quality video URL
+    video_versions = data.get("video_versions", [])
+    if not video_versions:
+        raise NotFound("❌ Відео не знайдено у відповіді API")
+
+    # Highest resolution first
+    video_versions = sorted(video_versions, key=lambda x: x.get("width", 0), reverse=True)
+    return await _reel([(v["url"], v.get("height")) for v in video_versions], data.get("video_duration"))
+
+
+def _instaloader_video(shortcode: str) -> tuple[str, float | None, int | None]:
+    import instaloader
+
+    class FailFast(instaloader.RateController):
+        # Instaloader waits out 429s for minutes by default; the next backend is faster.
+        def sleep(self, secs: float):
+            raise instaloader.TooManyRequestsException(f"rate limited, retry in {secs:.0f}s")
+
+    loader = instaloader.Instaloader(
+        quiet=True, download_pictures=False, download_videos=False, save_metadata=False,
+        max_connection_attempts=1, rate_controller=FailFast,
+    )
+    post = instaloader.Post.from_shortcode(loader.context, shortcode)
+    if not post.is_video:
+        raise NotFound("❌ Це не відео")
+    return post.video_url, post.video_duration, post.dimensions[1]
+
+
+async def fetch_reel_instaloader(shortcode: str) -> dict:
+    video_url, duration, height = await run_blocking(_instaloader_video, shortcode)
+    return await _reel([(video_url, height)], duration)
+
+
+async def fetch_reel_ytdlp(shortcode: str) -> dict:
+    info = await ytdlp.extract_info(f"https://www.instagram.com/reel/{shortcode}/")
+    # Progressive formats only: a direct download has nothing to merge the DASH streams with.
+    progressive = [f for f in info.get("formats") or []
+                   if f.get("url") and f.get("vcodec") != "none" and f.get("acodec") != "none"]
+    if not progressive and info.get("url"):
+        progressive = [info]
+    if not progressive:
+        raise NotFound("❌ yt-dlp не знайшов відео")
+    progressive.sort(key=lambda f: f.get("height") or 0, reverse=True)
+    return await _reel([(f["url"], f.get("height")) for f in progressive], info.get("duration"))
+
+
+instagram_provider = Provider("instagram", backends_from_env("instagram", {
+    "rapidapi": fetch_reel_rapidapi,
+    "instaloader": fetch_reel_instaloader,
+    "ytdlp": fetch_reel_ytdlp,
+}, default="rapidapi,instaloader,ytdlp"))
+
 
-            # Check if we got a valid response
-            if not data:
-                raise Exception("❌ Відповідь API порожня")
+@timed("resolve", "instagram")
+async def fetch_reel(reel_url: str) -> dict:
+    link = classify(reel_url)
+    if not link or link.platform != "instagram" or link.kind == "short":
+        raise Exception("❌ Не вдалося витягнути shortcode з URL")
+    return await instagram_provider.resolve(link.media_id)
 
-            # Get the best quality video URL
-            video_versions = data.get("video_versions", [])
-            if not video_versions:
-                raise Exception("❌ Відео не знайдено у відповіді API")
 
-            # Select the highest resolution video
-            video_url = max(video_versions, key=lambda x: x.get("width", 0))["url"]
+def pick_reel_version(reel: dict) -> tuple[str, int | None]:
+    """
+    Найкраща версія в межах політики форматів Instagram (висота й розмір), інакше
+    найкраща, що вміщається в ліміт Telegram (або MediaTooLarge).
+    """
+    check_limits(duration=reel["duration"])
+    policy = formats.policy_for("instagram")
+    versions = reel["versions"]
+    for url, size, height in versions:
+        if (size is None or size <= policy.max_size) and (height or 0) <= policy.max_height:
+            return url, size
+    for url, size, _ in versions:
+        if size is None or fits(size):
+            return url, size
+    # Every version is over the limit.
+    check_limits(size=min(size for _, size, _ in versions))
 
-            filename = f"{uuid.uuid4()}.mp4"
-            file_path = os.path.join(DOWNLOADS_FOLDER, filename)
 
-            async with session.get(video_url) as media_resp:
-                if media_resp.status == 200:
-                    with open(file_path, "wb") as f:
-                        f.write(await media_resp.read())
-                    return file_path
-                else:
-                    raise Exception(f"❌ Не вдалося завантажити файл: HTTP {media_resp.status}")
+async def resolve_reel_media(reel_url: str) -> tuple[str, int | None]:
+    reel = await cached_resolve("instagram", reel_url, lambda: fetch_reel(reel_url))
+    return pick_reel_version(reel)
 
-def convert_video_to_mp3(video_path: str) -> tuple[str | None, str | None]:
 
+async def resolve_reel(reel_url: str) -> str | None:
     try:
-        output_path = video_path.replace(".mp4", ".mp3")
-        clip = VideoFileClip(video_path)
-        clip.audio.write_audiofile(output_path)
-        clip.close()
-        return output_path, None
-    except Exception as e:
-        return None, str(e)
+        return (await resolve_reel_media(reel_url))[0]
+    except MediaTooLarge:
+        return None
 
-#https://www.instagram.com/reel/DL8T0dioRJm/?igsh=MXdhbXlnanJjMHd1Zw==
-@router.message(F.text.regexp(r"(https?://)?(www\.)?(instagram\.com/reel/)([a-zA-Z0-9_-]+)"))
-async def handle_instagram_reel(message: Message):
-    url = message.text.strip()
-    bot_username = (await bot.get_me()).username
-    await message.answer("⏳ Download Instagram...")
 
-    loop = asyncio.get_running_loop()
+@timed("download", "instagram", size_of=file_size)
+async def download_reel(reel_url: str) -> str:
+    video_url, size = await resolve_reel_media(reel_url)
+    workspace = workspaces.open("instagram")
+    file_path = workspace.file(f"{uuid.uuid4()}.mp4")
+
     try:
-        video_path = await loop.run_in_executor(None, lambda: asyncio.run(download_reel(url)))
-    except Exception as e:
-        await message.answer(f"❌ Error: {e}")
-        return
+        await download_file(video_url, file_path, on_size=lambda total: workspaces.admit(workspace, size or total))
+        file_path = await formats.prepare_video(file_path, formats.policy_for("instagram"), workspace)
+    except BaseException:
+        workspaces.release(workspace)
+        raise
+    return file_path
+
+@timed("convert", "instagram", error_of=lambda r: r[1], size_of=lambda r: file_size(r[0]))
+async def convert_video_to_mp3(video_path: str, user_id: int | None = None) -> tuple[str | None, str | None]:
+    # The MP3 lives next to the reel; the folder goes once both are released.
+    workspace = workspaces.retain(video_path)
+    output_path = workspace.file(f"{uuid.uuid4()}.mp3")
+    try:
+        error = await scheduler.run("instagram", user_id, lambda: extract_audio(video_path, output_path))
+    except BaseException:
+        workspaces.release(workspace)
+        raise
+    if error:
+        workspaces.release(workspace)
+        return None, error
+    return output_path, None
+
+async def download_reel_mp3(url: str, user_id: int | None = None,
+                            on_position=None) -> tuple[str | None, str | None]:
+    # Reuses the reel from a recent (or concurrent) video reply when it is still on disk.
+    # Slots are only taken inside the flights: holding one while waiting on a video
+    # flight that is itself queued could deadlock the platform's queue.
+    video_key = make_key("instagram", extract_media_id("instagram", url), "video")
+    factory = lambda: scheduler.run("instagram", user_id, lambda: download_reel(url), on_position=on_position)
+    async with downloads.join(video_key, factory, cleanup=workspaces.release, linger=DOWNLOAD_LINGER) as flight:
+        return await convert_video_to_mp3(flight.result, user_id)
 
-    unique_id = str(uuid.uuid4())
-    callback_store[unique_id] = url
+#https://www.instagram.com/reel/DL8T0dioRJm/?igsh=MXdhbXlnanJjMHd1Zw==
+@router.message(LinkFilter("instagram", kinds=("reel",)))
+async def handle_instagram_reel(message: Message, bot: Bot, link: Link):
+    url = link.url
+    username = await bot_username(bot)
+
+    unique_id = callback_store.add(url, "instagram", link.media_id)
+    keyboard = mp3_keyboard("convert_mp3", unique_id)
+
+    cache_key = link.key("video")
+    cached_file_id = file_cache.get(cache_key)
+    if cached_file_id and await file_cache.resend(
+        cache_key, cached_file_id,
+        lambda file_id: message.answer_video(file_id, caption=video_caption(username), reply_markup=keyboard)
+    ):
+        return
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🎵 Download in MP3", callback_data=f"convert_mp3|{unique_id}")]
-    ])
+    status = await message.answer("⏳ Download Instagram...")
+    sent = await answer_video_streamed(
+        message, "instagram", cache_key, lambda: resolve_reel(url),
+        keep_as=lambda path: path, cleanup=workspaces.release,
+        caption=video_caption(username), reply_markup=keyboard
+    )
+    if sent:
+        await finish_status(status)
+        return
 
-    video_file = FSInputFile(video_path)
-    await message.answer_video(
-        video_file,
-        caption=f"🔗 Download audio here 👉 @{bot_username}",
-        reply_markup=keyboard
+    factory = lambda: scheduler.run(
+        "instagram", message.from_user.id, lambda: download_reel(url),
+        on_position=queue_status(status, "⏳ Download Instagram...")
     )
 
-    # Очищення відео після відправлення (можна робити пізніше)
-    if os.path.exists(video_path):
-        os.remove(video_path)
+    try:
+        async with downloads.join(cache_key, factory, cleanup=workspaces.release, linger=DOWNLOAD_LINGER) as flight:
+            video_path = flight.result
+            async with flight.lock:
+                sent = await message.answer_video(
+                    flight.file_id or input_file(video_path),
+                    caption=video_caption(username),
+                    reply_markup=keyboard
+                )
+                if not flight.file_id and sent.video:
+                    flight.file_id = sent.video.file_id
+                    file_cache.put(cache_key, flight.file_id)
+        await finish_status(status)
+    except MediaTooLarge as e:
+        await finish_status(status, str(e))
+    except Exception as e:
+        await finish_status(status, f"❌ Error: {e}")
 
 
 @router.callback_query(F.data.startswith("convert_mp3|"))
-async def convert_to_mp3_instagram(callback: CallbackQuery):
+async def convert_to_mp3_instagram(callback: CallbackQuery, bot: Bot):
     parts = callback.data.split("|")
-    bot_username = (await bot.get_me()).username
+    username = await bot_username(bot)
     unique_id = parts[1]
-    url = callback_store.get(unique_id)
+    entry = callback_store.get(unique_id)
 
-    if not url:
+    if not entry:
         await callback.message.answer("❌ Error is not active.")
         return
 
-    await callback.message.answer("⏳ Convert in MP3...")
-
-    loop = asyncio.get_running_loop()
-    try:
-        video_path = await loop.run_in_executor(None, lambda: asyncio.run(download_reel(url)))
-    except Exception as e:
-        await callback.message.answer(f"❌ Error: {e}")
-        return
-
-    mp3_path, error = await loop.run_in_executor(None, convert_video_to_mp3, video_path)
-
-    if error:
-        await callback.message.answer(f"❌ Error: {error}")
-        return
+    url = entry.url
+    cache_key = make_key("instagram", entry.media_id, "mp3")
+    cached_file_id = entry.file_id or file_cache.get(cache_key)
+    if cached_file_id:
+        if await file_cache.resend(
+            cache_key, cached_file_id, lambda file_id: callback.message.answer_audio(file_id, caption=audio_caption(username))
+        ):
+            return
+        callback_store.drop_file_id(unique_id)
+
+    status = await callback.message.answer("⏳ Convert in MP3...")
+    factory = lambda: download_reel_mp3(
+        url, callback.from_user.id, on_position=queue_status(status, "⏳ Convert in MP3...")
+    )
 
-    audio_file = FSInputFile(mp3_path)
     try:
-        await callback.message.answer_audio(
-            audio_file,
-            caption=f"🔗 Download audio here 👉 @{bot_username}",
-        )
+        async with downloads.join(cache_key, factory, cleanup=lambda r: workspaces.release(r[0])) as flight:
+            mp3_path, error = flight.result
+
+            if error:
+                await finish_status(status, f"❌ Error: {error}")
+                return
+
+            try:
+                async with flight.lock:
+                    sent = await callback.message.answer_audio(
+                        flight.file_id or input_file(mp3_path),
+                        caption=audio_caption(username),
+                    )
+                    if not flight.file_id and sent.audio:
+                        flight.file_id = sent.audio.file_id
+                        file_cache.put(cache_key, flight.file_id)
+                    callback_store.set_file_id(unique_id, flight.file_id)
+                await finish_status(status)
+            except Exception as e:
+                await finish_status(status, f"❌ Помилка надсилання: {e}")
+    except MediaTooLarge as e:
+        await finish_status(status, str(e))
     except Exception as e:
-        await callback.message.answer(f"❌ Помилка надсилання: {e}")
-    finally:
-        if os.path.exists(video_path):
-            os.remove(video_path)
-        if os.path.exists(mp3_path):
-            os.remove(mp3_path)
+        await finish_status(status, f"❌ Error: {e}")
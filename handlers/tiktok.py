@@ -1,33 +1,44 @@
 import os
 import uuid
-import requests
 import random
 import string
 import asyncio
-import subprocess
-from moviepy import VideoFileClip
-
-from aiogram import Router, F
-from aiogram.types import (
-    Message, CallbackQuery, InlineKeyboardMarkup,
-    InlineKeyboardButton, InputMediaPhoto
-)
-from aiogram.types.input_file import FSInputFile
-from yt_dlp import YoutubeDL
-
-from main import bot, logging
+import logging
+import httpx
+from typing import NamedTuple
+
+from aiogram import Bot, Router, F
+from aiogram.types import Message, CallbackQuery, InputMediaPhoto
+from aiogram.types.input_file import BufferedInputFile
+
+from services import formats, probe, ytdlp
+from services.botapi import input_file
+from services.cache import file_cache, make_key
+from services.callbacks import callback_store
+from services.links import Link, LinkFilter, extract_media_id
+from services.http import fetch_bytes, fetch_json
+from services.ranged import download_file
+from services.metrics import timed, file_size
+from services.providers import NotFound, Provider, ProviderError, backends_from_env
+from services.resolve import MediaTooLarge, cached_resolve, check_limits, fits
+from services.scheduler import scheduler, queue_status
+from services.audio import extract_audio
+from services.singleflight import downloads, DOWNLOAD_LINGER
+from services.streaming import answer_video_streamed
+from services.ui import bot_username, video_caption, audio_caption, photos_caption, mp3_keyboard, finish_status
+from services.workspace import workspaces
 
 # -------- CONFIG --------
-DOWNLOADS_FOLDER = "services/downloads"
+TIKWM_API_URL = os.getenv("TIKWM_API_URL", "https://tikwm.com/api/")
+TIKWM_MEDIA_URL = os.getenv("TIKWM_MEDIA_URL", "https://tikwm.com/video/media/{variant}/{video_id}.mp4")
+TIKTOK_VIDEO_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+# Enough to fetch a whole slideshow in one round; services.http still caps it per host.
+TIKTOK_IMAGE_CONCURRENCY = 16
+TIKTOK_SLIDESHOW_MUSIC = os.getenv("TIKTOK_SLIDESHOW_MUSIC", "1") == "1"
+MEDIA_GROUP_LIMIT = 10
 router = Router()
-callback_store = {}  
-callback_store_sizes = {}  
 
 # -------- UTILS --------
-def ensure_downloads_folder_exists(folder: str = DOWNLOADS_FOLDER):
-    if not os.path.exists(folder):
-        os.makedirs(folder)
-
 def sanitize_filename(filename: str) -> str:
     return "".join(c if c.isalnum() or c in "-_." else "_" for c in filename)
 
@@ -35,29 +46,35 @@ async def generate_random_string(length: int = 8) -> str:
     return ''.join(random.choices(string.ascii_lowercase + string.digits, k=length))
 
 # -------- MP3 CONVERSION --------
-async def get_audio_stream(url: str) -> tuple[str | None, str | None, str | None]:
+@timed("audio", "tiktok", error_of=lambda r: r[2], size_of=lambda r: file_size(r[0]))
+async def get_audio_stream(url: str, user_id: int | None = None,
+                           on_position=None) -> tuple[str | None, str | None, str | None]:
+    # Reuses the video from a recent (or concurrent) video reply when it is still on disk.
+    # Slots are only taken inside the flights: holding one while waiting on a video
+    # flight that is itself queued could deadlock the platform's queue.
+    video_key = make_key("tiktok", extract_media_id("tiktok", url), "video")
+    factory = lambda: scheduler.run("tiktok", user_id, lambda: download_tiktok(url), on_position=on_position)
     try:
-        ensure_downloads_folder_exists()
-        temp_video = f"{uuid.uuid4()}.mp4"
-        output_mp3 = temp_video.replace(".mp4", ".mp3")
-
-        ydl_opts = {
-            "quiet": True,
-            "format": "mp4",
-            "outtmpl": temp_video,
-            "noplaylist": True
-        }
-
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            title = info.get("title", "audio")
-
-        subprocess.run(
-            ["ffmpeg", "-i", temp_video, "-vn", "-ab", "192k", "-ar", "44100", "-y", output_mp3],
-            check=True
-        )
-        os.remove(temp_video)
-        return output_mp3, title, None
+        async with downloads.join(video_key, factory, cleanup=release_download, linger=DOWNLOAD_LINGER) as flight:
+            video_path, content_type, error = flight.result
+            if error:
+                downloads.forget(video_key)
+                return None, None, error
+            if content_type != "video":
+                return None, None, "❌ This TikTok has no video to convert."
+
+            # The MP3 lives next to the video; the folder goes once both are released.
+            workspace = workspaces.retain(video_path)
+            output_mp3 = workspace.file(f"{uuid.uuid4()}.mp3")
+            try:
+                error = await scheduler.run("tiktok", user_id, lambda: extract_audio(video_path, output_mp3))
+            except BaseException:
+                workspaces.release(workspace)
+                raise
+            if error:
+                workspaces.release(workspace)
+                return None, None, f"❌ Conversion failed: {error}"
+            return output_mp3, "audio", None
     except Exception as e:
         logging.error(f"Error converting to MP3: {e}")
         return None, None, f"❌ Conversion failed: {e}"
@@ -68,166 +85,307 @@ class DownloaderTikTok:
         self.output_dir = output_dir
         self.filename = filename
 
-    async def download_video(self, url_or_id: str) -> bool:
-        return await asyncio.to_thread(self._download_video_sync, url_or_id)
-
-    def _download_video_sync(self, url_or_id: str) -> bool:
+    async def download_url(self, download_url: str, headers: dict | None = None, on_size=None) -> bool:
         try:
-            video_id = url_or_id
-            if url_or_id.startswith("http"):
-                video_id = url_or_id.split("/")[-1].split("?")[0]
-
-            download_url = f"https://tikwm.com/video/media/play/{video_id}.mp4"
-            response = requests.get(download_url, allow_redirects=True, timeout=20)
-            response.raise_for_status()
-
-            os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
-            with open(self.filename, "wb") as f:
-                f.write(response.content)
+            await download_file(download_url, self.filename, headers=headers,
+                                timeout=TIKTOK_VIDEO_TIMEOUT, on_size=on_size)
             return True
         except Exception as e:
-            logging.error(f"Error downloading TikTok video {url_or_id}: {e}")
+            logging.error(f"Error downloading TikTok video {download_url}: {e}")
             return False
 
-    async def get_video_size(self, path: str) -> tuple[int, int]:
-        return await asyncio.to_thread(self._get_size_sync, path)
-
-    def _get_size_sync(self, path: str) -> tuple[int, int]:
-        with VideoFileClip(path) as clip:
-            return clip.size
+    async def get_video_size(self, path: str) -> tuple[int | None, int | None]:
+        return await probe.get_video_size(path)
 
 # -------- TIKTOK DOWNLOAD LOGIC --------
-async def download_tiktok(url: str) -> tuple[str | list[str] | None, str | None, str | None]:
+async def fetch_tikwm(url: str) -> dict:
+    data = await fetch_json(TIKWM_API_URL, params={"url": url}, timeout=15)
+    if data.get("data"):
+        return data["data"]
+    message = data.get("msg") or "empty response"
+    # tikwm answers 200 with code -1 both for missing posts and for its own rate limit.
+    if "limit" in message.lower():
+        raise RuntimeError(f"tikwm: {message}")
+    raise NotFound(message)
+
+async def fetch_tiktok_ytdlp(url: str) -> dict:
+    """
+    Запасний бекенд: ті самі поля, що й у tikwm, але `play` — пряме посилання,
+    для якого потрібні `http_headers`. Слайдшоу yt-dlp не підтримує.
+    """
+    info = await ytdlp.extract_info(url, format="best[vcodec^=h264]/best")
+    if not info.get("url"):
+        raise NotFound("yt-dlp found no video")
+    return {
+        "id": info.get("id"),
+        "duration": info.get("duration"),
+        "play": info["url"],
+        "size": formats.format_size(info, info.get("duration")),
+        "http_headers": info["http_headers"],
+    }
+
+tiktok_provider = Provider("tiktok", backends_from_env(
+    "tiktok", {"tikwm": fetch_tikwm, "ytdlp": fetch_tiktok_ytdlp}, default="tikwm,ytdlp"
+))
+
+@timed("resolve", "tiktok")
+async def fetch_tiktok(url: str) -> dict:
+    return await tiktok_provider.resolve(url)
+
+async def resolve_tiktok(url: str) -> dict | None:
     try:
-        ensure_downloads_folder_exists()
-        api_url = f"https://tikwm.com/api/?url={url}"
-
-        resp = requests.get(api_url, timeout=15)
-        resp.raise_for_status()
-        data = resp.json()
-
-        if not data.get("data"):
+        # Failures are not cached, so the next request asks the backends again.
+        return await cached_resolve("tiktok", url, lambda: fetch_tiktok(url))
+    except ProviderError as e:
+        logging.warning(f"Cannot resolve TikTok {url}: {e}")
+        return None
+
+def tiktok_media(post_data: dict, variant: str, url: str) -> tuple[str, dict | None]:
+    """
+    URL відео і заголовки до нього: проксі tikwm або пряме посилання від yt-dlp.
+    """
+    if "http_headers" in post_data:
+        return post_data[variant], post_data["http_headers"]
+    video_id = post_data.get("id") or extract_media_id("tiktok", url)
+    return TIKWM_MEDIA_URL.format(variant=variant, video_id=video_id), None
+
+def pick_tiktok_variant(post_data: dict) -> tuple[str, int | None]:
+    """
+    Звичайна якість (H.264), якщо вміщається в ліміт політики форматів TikTok, інакше HD (або MediaTooLarge).
+    """
+    check_limits(duration=post_data.get("duration"))
+    max_size = formats.policy_for("tiktok").max_size
+    # tikwm does not report codecs, and its HD variant is often HEVC, which many clients do not play inline.
+    for variant, size_field in (("play", "size"), ("hdplay", "hd_size")):
+        if fits(post_data.get(size_field)) and post_data[size_field] <= max_size:
+            return variant, post_data[size_field]
+    check_limits(size=post_data.get("size"))
+    return "play", None
+
+async def resolve_tiktok_video_url(url: str) -> str | None:
+    post_data = await resolve_tiktok(url)
+    if not post_data or post_data.get("images"):
+        return None
+    try:
+        variant, _ = pick_tiktok_variant(post_data)
+    except MediaTooLarge:
+        return None
+    media_url, headers = tiktok_media(post_data, variant, url)
+    # Streaming cannot send the cookies a direct CDN link needs; that goes through a download.
+    return None if headers else media_url
+
+class Slideshow(NamedTuple):
+    images: list[bytes]
+    music: bytes | None = None
+    music_title: str | None = None
+
+    @property
+    def size(self) -> int:
+        return sum(len(i) for i in self.images) + len(self.music or b"")
+
+def release_download(result: tuple):
+    # Slideshows live in memory; only videos hold a workspace.
+    media, content_type, _ = result
+    if content_type == "video":
+        workspaces.release(media)
+
+async def download_slideshow(post_data: dict) -> Slideshow:
+    """
+    Усі слайди (і музика) паралельно, в пам'ять — на диск нічого не пишеться.
+    """
+    fan_out = asyncio.Semaphore(TIKTOK_IMAGE_CONCURRENCY)
+
+    async def fetch(media_url: str) -> bytes | None:
+        try:
+            async with fan_out:
+                return await fetch_bytes(media_url, timeout=15)
+        except Exception as e:
+            logging.warning(f"Failed to download {media_url}: {e}")
+            return None
+
+    music_info = post_data.get("music_info") or {}
+    music_url = (music_info.get("play") or post_data.get("music")) if TIKTOK_SLIDESHOW_MUSIC else None
+    fetched = await asyncio.gather(*(fetch(u) for u in post_data["images"]), *([fetch(music_url)] if music_url else []))
+    images = fetched[:len(post_data["images"])]
+    music = fetched[-1] if music_url else None
+    return Slideshow([i for i in images if i], music, music_info.get("title"))
+
+@timed("download", "tiktok", error_of=lambda r: r[2],
+       size_of=lambda r: r[0].size if r[1] == "photo" else file_size(r[0]))
+async def download_tiktok(url: str) -> tuple[str | Slideshow | None, str | None, str | None]:
+    try:
+        post_data = await resolve_tiktok(url)
+        if not post_data:
             return None, None, "⚠️ Could not fetch TikTok video from API."
 
-        post_data = data["data"]
+        if post_data.get("images"):
+            slideshow = await download_slideshow(post_data)
+            if not slideshow.images:
+                return None, None, "⚠️ Failed to download TikTok photos."
+            return slideshow, "photo", None
 
-        if "images" in post_data and post_data["images"]:
-            image_urls = post_data["images"]
-            image_folder = os.path.join(DOWNLOADS_FOLDER, str(uuid.uuid4()))
-            os.makedirs(image_folder, exist_ok=True)
-            image_paths = []
-            for idx, img_url in enumerate(image_urls):
-                try:
-                    img_data = requests.get(img_url, timeout=15).content
-                    img_path = os.path.join(image_folder, f"slide_{idx + 1}.jpg")
-                    with open(img_path, "wb") as f:
-                        f.write(img_data)
-                    image_paths.append(img_path)
-                except Exception as e:
-                    logging.warning(f"Failed to download image {img_url}: {e}")
-            return image_paths, "photo", None
+        try:
+            variant, size = pick_tiktok_variant(post_data)
+        except MediaTooLarge as e:
+            return None, None, str(e)
 
-        video_id = post_data.get("id") or url.split("/")[-1].split("?")[0]
+        media_url, headers = tiktok_media(post_data, variant, url)
         filename_prefix = f"{await generate_random_string()}_video.mp4"
-        output_path = os.path.join(DOWNLOADS_FOLDER, sanitize_filename(filename_prefix))
-
-        downloader = DownloaderTikTok(DOWNLOADS_FOLDER, output_path)
-        success = await downloader.download_video(video_id)
-        if not success or not os.path.exists(output_path):
-            return None, None, "⚠️ Failed to download TikTok video."
+        workspace = workspaces.open("tiktok")
+        output_path = workspace.file(sanitize_filename(filename_prefix))
 
         try:
-            width, height = await downloader.get_video_size(output_path)
-        except Exception as e:
-            logging.warning(f"Cannot get video size: {e}")
-            width, height = None, None
+            downloader = DownloaderTikTok(workspace.path, output_path)
+            success = await downloader.download_url(
+                media_url, headers, on_size=lambda total: workspaces.admit(workspace, size or total)
+            )
+            if not success or not os.path.exists(output_path):
+                workspaces.release(workspace)
+                return None, None, "⚠️ Failed to download TikTok video."
+            output_path = await formats.prepare_video(output_path, formats.policy_for("tiktok"), workspace)
+        except BaseException:
+            workspaces.release(workspace)
+            raise
 
-        callback_store_sizes[output_path] = (width, height)
         return output_path, "video", None
 
     except Exception as e:
         logging.exception("Error downloading TikTok")
         return None, None, f"❌ Error downloading TikTok: {e}"
 
+async def send_slideshow(message: Message, slideshow: Slideshow, username: str):
+    """
+    Надсилає слайди групами по MEDIA_GROUP_LIMIT у правильному порядку, потім музику.
+    """
+    for start in range(0, len(slideshow.images), MEDIA_GROUP_LIMIT):
+        chunk = [
+            BufferedInputFile(data, filename=f"slide_{start + idx + 1}.jpg")
+            for idx, data in enumerate(slideshow.images[start:start + MEDIA_GROUP_LIMIT])
+        ]
+        caption = photos_caption(username) if start == 0 else None
+        if len(chunk) == 1:
+            # A media group needs at least two items.
+            await message.answer_photo(chunk[0], caption=caption)
+            continue
+        # aiogram models are frozen, so the caption has to go in through the constructor.
+        media_group = [InputMediaPhoto(media=photo, caption=caption if idx == 0 else None)
+                       for idx, photo in enumerate(chunk)]
+        await message.answer_media_group(media_group)
+
+    if slideshow.music:
+        await message.answer_audio(
+            BufferedInputFile(slideshow.music, filename="music.mp3"),
+            title=slideshow.music_title,
+            caption=audio_caption(username)
+        )
+
 # -------- MESSAGE HANDLER --------
-@router.message(F.text.regexp(r"(https?://)?(www\.)?(tiktok\.com/.+|vm\.tiktok\.com/.+|vt\.tiktok\.com/.+)"))
-async def handle_tiktok(message: Message):
-    url = message.text.strip()
-    bot_username = (await bot.get_me()).username
-    await message.answer("⏳ Downloading TikTok...")
-
-    result, content_type, error = await download_tiktok(url)
-    if error:
-        await message.answer(error)
+@router.message(LinkFilter("tiktok"))
+async def handle_tiktok(message: Message, bot: Bot, link: Link):
+    url = link.url
+    username = await bot_username(bot)
+
+    unique_id = callback_store.add(url, "tiktok", link.media_id)
+    keyboard = mp3_keyboard("convert_mp3_tiktok", unique_id)
+    caption = video_caption(username)
+
+    cache_key = link.key("video")
+    cached_file_id = file_cache.get(cache_key)
+    if cached_file_id and await file_cache.resend(
+        cache_key, cached_file_id, lambda file_id: message.answer_video(file_id, caption=caption, reply_markup=keyboard)
+    ):
         return
 
-    try:
-        if content_type == "photo":
-            media_group = [InputMediaPhoto(media=FSInputFile(p)) for p in result]
-            await message.answer_media_group(media_group)
-            await message.answer(f"📸 Download photos here 👉 @{bot_username}")
-
-            for path in result:
-                if os.path.exists(path):
-                    os.remove(path)
-            try:
-                os.rmdir(os.path.dirname(result[0]))
-            except Exception:
-                pass
-
-        else:
-            unique_id = str(uuid.uuid4())
-            callback_store[unique_id] = url
-            width_height = callback_store_sizes.get(result, (None, None))
-            width, height = width_height
-
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[[
-                InlineKeyboardButton(
-                    text="🎵 Download in MP3",
-                    callback_data=f"convert_mp3_tiktok|{unique_id}"
-                )
-            ]])
-
-            video_file = FSInputFile(result)
-            await message.answer_video(
-                video_file,
-                caption=f"🔗 Download video here 👉 @{bot_username}",
-                reply_markup=keyboard,
-                **({"width": width, "height": height} if width and height else {})
-            )
+    status = await message.answer("⏳ Downloading TikTok...")
+    sent = await answer_video_streamed(
+        message, "tiktok", cache_key, lambda: resolve_tiktok_video_url(url),
+        keep_as=lambda path: (path, "video", None), cleanup=release_download,
+        caption=caption, reply_markup=keyboard
+    )
+    if sent:
+        await finish_status(status)
+        return
 
-            if os.path.exists(result):
-                os.remove(result)
+    factory = lambda: scheduler.run(
+        "tiktok", message.from_user.id, lambda: download_tiktok(url),
+        on_position=queue_status(status, "⏳ Downloading TikTok...")
+    )
 
-    except Exception as e:
-        await message.answer(f"❌ Error: {e}")
+    async with downloads.join(cache_key, factory, cleanup=release_download, linger=DOWNLOAD_LINGER) as flight:
+        result, content_type, error = flight.result
+        if error:
+            downloads.forget(cache_key)
+            await finish_status(status, error)
+            return
+
+        try:
+            if content_type == "photo":
+                await send_slideshow(message, result, username)
+
+            else:
+                try:
+                    width, height = await probe.get_video_size(result)
+                except Exception as e:
+                    logging.warning(f"Cannot get video size: {e}")
+                    width, height = None, None
+
+                async with flight.lock:
+                    sent = await message.answer_video(
+                        flight.file_id or input_file(result),
+                        caption=caption,
+                        reply_markup=keyboard,
+                        **({"width": width, "height": height} if width and height else {})
+                    )
+                    if not flight.file_id and sent.video:
+                        flight.file_id = sent.video.file_id
+                        file_cache.put(cache_key, flight.file_id)
+            await finish_status(status)
+
+        except Exception as e:
+            await finish_status(status, f"❌ Error: {e}")
 
 # -------- CALLBACK HANDLER FOR MP3 --------
 @router.callback_query(F.data.startswith("convert_mp3_tiktok"))
-async def convert_to_mp3(callback: CallbackQuery):
-    bot_username = (await bot.get_me()).username
+async def convert_to_mp3(callback: CallbackQuery, bot: Bot):
+    username = await bot_username(bot)
     parts = callback.data.split("|")
     unique_id = parts[1]
-    url = callback_store.get(unique_id)
+    entry = callback_store.get(unique_id)
 
-    if not url:
+    if not entry:
         await callback.message.answer("❌ URL not found")
         return
 
-    await callback.message.answer("⏳ Converting to MP3...")
-    filename, title, error = await get_audio_stream(url)
-    if error:
-        await callback.message.answer(error)
-        return
+    url = entry.url
+    cache_key = make_key("tiktok", entry.media_id, "mp3")
+    cached_file_id = entry.file_id or file_cache.get(cache_key)
+    if cached_file_id:
+        if await file_cache.resend(
+            cache_key, cached_file_id, lambda file_id: callback.message.answer_audio(file_id, caption=audio_caption(username))
+        ):
+            return
+        callback_store.drop_file_id(unique_id)
+
+    status = await callback.message.answer("⏳ Converting to MP3...")
+    factory = lambda: get_audio_stream(
+        url, callback.from_user.id, on_position=queue_status(status, "⏳ Converting to MP3...")
+    )
+    async with downloads.join(cache_key, factory, cleanup=lambda r: workspaces.release(r[0])) as flight:
+        filename, title, error = flight.result
+        if error:
+            await finish_status(status, error)
+            return
 
-    try:
-        audio_file = FSInputFile(filename)
-        await callback.message.answer_audio(
-            audio_file,
-            caption=f"🔗 Download audio here 👉 @{bot_username}"
-        )
-    except Exception as e:
-        await callback.message.answer(f"❌ Error: {e}")
-    finally:
-        if os.path.exists(filename):
-            os.remove(filename)
+        try:
+            async with flight.lock:
+                sent = await callback.message.answer_audio(
+                    flight.file_id or input_file(filename),
+                    caption=audio_caption(username)
+                )
+                if not flight.file_id and sent.audio:
+                    flight.file_id = sent.audio.file_id
+                    file_cache.put(cache_key, flight.file_id)
+                callback_store.set_file_id(unique_id, flight.file_id)
+            await finish_status(status)
+        except Exception as e:
+            await finish_status(status, f"❌ Error: {e}")
@@ -1,6 +1,4 @@
 import os
-import uuid
-import requests
 import time
 import logging
 import random
@@ -9,25 +7,34 @@ import re
 import asyncio
 
 from aiogram import Bot, Router, F
-from aiogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
-from aiogram.types.input_file import FSInputFile
-from yt_dlp import YoutubeDL
-from moviepy import VideoFileClip, AudioFileClip
+from aiogram.types import Message, CallbackQuery
 
-from main import bot, BOT_TOKEN, admin_id
+from services import formats, probe
+from services.app import get_app
+from services.botapi import input_file
+from services.cache import file_cache, make_key
+from services.metrics import timed, file_size
+from services.resolve import MediaTooLarge, cached_resolve, check_limits, fits
+from services.callbacks import callback_store
+from services.links import Link, LinkFilter
+from services.scheduler import scheduler, queue_status
+from services.singleflight import downloads
+from services.ui import bot_username, video_caption, audio_caption, mp3_keyboard, finish_status
+from services.workspace import workspaces
+from services.ytdlp import youtube_dl
 
 router = Router()
-DOWNLOADS_FOLDER = "services/downloads"
-MAX_FILE_SIZE = 500 * 1024 * 1024  # 500MB
 
-callback_store = {}
 
 # ------------------------- UTILS -------------------------
 
 def custom_oauth_verifier(verification_url, user_code):
-    send_message_url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
+    import requests
+
+    app = get_app()
+    send_message_url = app.bot.session.api.api_url(app.token, "sendMessage")
     params = {
-        "chat_id": admin_id,
+        "chat_id": app.admin_id,
         "text": f"<b>OAuth Verification</b>\n\nOpen this URL:\n{verification_url}\nEnter this code:\n<code>{user_code}</code>",
         "parse_mode": "HTML"
     }
@@ -43,10 +50,6 @@ def custom_oauth_verifier(verification_url, user_code):
 def sanitize_filename(filename):
     return re.sub(r'[<>:"/\\|?*]', '_', filename)
 
-def ensure_downloads_folder_exists():
-    if not os.path.exists(DOWNLOADS_FOLDER):
-        os.makedirs(DOWNLOADS_FOLDER)
-
 def generate_random_string(length=8):
     return ''.join(random.choices(string.ascii_lowercase + string.digits, k=length))
 
@@ -54,104 +57,207 @@ async def safe_remove(file_path):
     if os.path.exists(file_path):
         await asyncio.to_thread(os.remove, file_path)
 
-async def get_clip_dimensions(file_path: str):
+async def get_clip_dimensions(file_path: str, info: dict | None = None):
     try:
-        return await asyncio.to_thread(lambda: VideoFileClip(file_path).size)
+        return await probe.get_video_size(file_path, info)
     except Exception as e:
         logging.error(f"Error getting video dimensions: {e}")
         return None, None
 
-async def get_audio_duration(file_path: str):
+async def get_audio_duration(file_path: str, info: dict | None = None):
     try:
-        return await asyncio.to_thread(lambda: AudioFileClip(file_path).duration)
+        return await probe.get_duration(file_path, info) or 0
     except Exception as e:
         logging.error(f"Error getting audio duration: {e}")
         return 0
 
+# ------------------------- YT_DLP RESOLVE -------------------------
+
+YDL_BASE_OPTS = {
+    "quiet": True,
+    "oauth": True,
+    "oauth_verifier": custom_oauth_verifier,
+}
+
+@timed("resolve", "youtube")
+async def fetch_youtube_info(url: str) -> dict:
+    loop = asyncio.get_running_loop()
+    with youtube_dl(YDL_BASE_OPTS) as ydl:
+        return await loop.run_in_executor(None, lambda: ydl.extract_info(url, download=False))
+
+async def resolve_youtube(url: str) -> dict:
+    return await cached_resolve("youtube", url, lambda: fetch_youtube_info(url))
+
+def pick_youtube_format(info: dict, is_audio: bool = False) -> tuple[str, int | None]:
+    """
+    Відео — за політикою форматів YouTube (services.formats); аудіо — найкраща доріжка в ліміті.
+    Повертає селектор yt-dlp і очікуваний розмір; кидає MediaTooLarge, якщо нічого не влазить.
+    """
+    if not is_audio:
+        choice = formats.select_video(info, formats.policy_for("youtube"))
+        logging.debug(f"YouTube {info.get('id')}: {choice.selector} ({choice.action})")
+        return choice.selector, choice.size
+
+    duration = info.get("duration")
+    check_limits(duration=duration)
+    audios = [f for f in info.get("formats") or []
+              if f.get("vcodec") == "none" and f.get("acodec") not in (None, "none")]
+    candidates = [(f["format_id"], formats.format_size(f, duration), (f.get("ext") == "m4a", f.get("abr") or 0))
+                  for f in audios]
+    sized = [c for c in candidates if c[1]]
+    if not sized:
+        # No size information at all (e.g. live or unusual extractors): let yt-dlp choose.
+        return "bestaudio[ext=m4a]/bestaudio/best", None
+    fitting = [c for c in sized if fits(c[1])]
+    if not fitting:
+        check_limits(size=min(c[1] for c in sized))
+    selector, size, _ = max(fitting, key=lambda c: c[2])
+    return selector, size
+
 # ------------------------- YT_DLP DOWNLOAD -------------------------
 
+@timed("download", "youtube", error_of=lambda r: r[2], size_of=lambda r: file_size(r[0]))
 async def download_media(url: str, is_audio=False):
-    ensure_downloads_folder_exists()
+    try:
+        resolved = await resolve_youtube(url)
+        format_selector, size = pick_youtube_format(resolved, is_audio)
+    except MediaTooLarge as e:
+        return None, None, str(e)
+    except Exception as e:
+        logging.error(f"YT_DLP resolve error: {e}")
+        return None, None, f"❌ Помилка завантаження: {e}"
+
+    workspace = workspaces.open("youtube")
     filename_prefix = generate_random_string()
-    outtmpl = os.path.join(DOWNLOADS_FOLDER, f"{filename_prefix}.%(ext)s")
+    outtmpl = workspace.file(f"{filename_prefix}.%(ext)s")
 
     ydl_opts = {
-        "format": "bestvideo+bestaudio/best" if is_audio else "bestvideo+bestaudio/best",
+        **YDL_BASE_OPTS,
+        "format": format_selector,
         "outtmpl": outtmpl,
-        "quiet": True,
         "merge_output_format": "mp4",
-        "oauth": True,
-        "oauth_verifier": custom_oauth_verifier,
+        # Merging is a stream copy; faststart lets Telegram play before the download ends.
+        "postprocessor_args": formats.FASTSTART_MERGE_ARGS,
     }
+    if is_audio:
+        # Audio stream only; the ffmpeg postprocessor copies it when it is
+        # already mp3 and transcodes otherwise.
+        ydl_opts.pop("merge_output_format")
+        ydl_opts.pop("postprocessor_args")
+        ydl_opts["postprocessors"] = [{
+            "key": "FFmpegExtractAudio",
+            "preferredcodec": "mp3",
+            "preferredquality": "192",
+        }]
 
     try:
+        await workspaces.admit(workspace, size)
         loop = asyncio.get_running_loop()
-        with YoutubeDL(ydl_opts) as ydl:
-            info = await loop.run_in_executor(None, lambda: ydl.extract_info(url, download=True))
-        ext = info.get("ext") or ("mp3" if is_audio else "mp4")
-        downloaded_file = outtmpl.replace("%(ext)s", ext)
+        with youtube_dl(ydl_opts) as ydl:
+            # Downloads from the resolved metadata instead of extracting it again.
+            reusable = ydl.sanitize_info(resolved, remove_private_keys=True)
+            info = await loop.run_in_executor(None, lambda: ydl.process_ie_result(reusable, download=True))
+        requested = info.get("requested_downloads") or [{}]
+        downloaded_file = requested[0].get("filepath")
+        if not downloaded_file:
+            ext = "mp3" if is_audio else (info.get("ext") or "mp4")
+            downloaded_file = outtmpl.replace("%(ext)s", ext)
+        if not is_audio:
+            downloaded_file = await formats.prepare_video(downloaded_file, formats.policy_for("youtube"), workspace)
         return downloaded_file, info, None
-    except Exception as e:
+    except BaseException as e:
+        workspaces.release(workspace)
+        if not isinstance(e, Exception):
+            raise
         logging.error(f"YT_DLP download error: {e}")
         return None, None, f"❌ Помилка завантаження: {e}"
 
 # ------------------------- CALLBACKS -------------------------
 
 @router.callback_query(F.data.startswith("convert_mp3_youtube"))
-async def convert_to_mp3_youtube(callback: CallbackQuery):
-    bot_username = (await bot.get_me()).username
+async def convert_to_mp3_youtube(callback: CallbackQuery, bot: Bot):
+    username = await bot_username(bot)
     unique_id = callback.data.split("|")[1]
-    url = callback_store.get(unique_id)
+    entry = callback_store.get(unique_id)
 
-    if not url:
+    if not entry:
         await callback.answer("Error: URL not found")
         return
 
-    await callback.message.answer("⏳ Converting in MP3...")
-    mp3_path, info, error = await download_media(url, is_audio=True)
+    url = entry.url
+    cache_key = make_key("youtube", entry.media_id, "mp3")
+    cached_file_id = entry.file_id or file_cache.get(cache_key)
+    if cached_file_id:
+        if await file_cache.resend(
+            cache_key, cached_file_id, lambda file_id: callback.message.answer_audio(file_id, caption=audio_caption(username))
+        ):
+            return
+        callback_store.drop_file_id(unique_id)
 
-    if error:
-        await callback.message.answer(error)
-        return
+    status = await callback.message.answer("⏳ Converting in MP3...")
+    factory = lambda: scheduler.run(
+        "youtube", callback.from_user.id, lambda: download_media(url, is_audio=True),
+        on_position=queue_status(status, "⏳ Converting in MP3...")
+    )
+    async with downloads.join(cache_key, factory, cleanup=lambda r: workspaces.release(r[0])) as flight:
+        mp3_path, info, error = flight.result
 
-    try:
-        await callback.message.answer_audio(FSInputFile(mp3_path), caption=f"🔗 Download audio 👉 @{bot_username}")
-    finally:
-        await safe_remove(mp3_path)
+        if error:
+            await finish_status(status, error)
+            return
 
-# ------------------------- MESSAGE HANDLERS -------------------------
+        async with flight.lock:
+            sent = await callback.message.answer_audio(flight.file_id or input_file(mp3_path), caption=audio_caption(username))
+            if not flight.file_id and sent.audio:
+                flight.file_id = sent.audio.file_id
+                file_cache.put(cache_key, flight.file_id)
+            callback_store.set_file_id(unique_id, flight.file_id)
+        await finish_status(status)
 
-@router.message(F.text.regexp(r"(https?://)?(www\.)?(youtube\.com/watch\?v=|youtu\.be/)([\w-]+)"))
-async def handle_youtube_url(message: Message):
-    bot_username = (await bot.get_me()).username
-    url = message.text.strip()
-    unique_id = str(uuid.uuid4())
-    callback_store[unique_id] = url
+# ------------------------- MESSAGE HANDLERS -------------------------
 
-    await message.answer("⏳ Downloading YouTube video...")
-    video_path, info, error = await download_media(url, is_audio=False)
+@router.message(LinkFilter("youtube"))
+async def handle_youtube_url(message: Message, bot: Bot, link: Link):
+    username = await bot_username(bot)
+    url = link.url
+    unique_id = callback_store.add(url, "youtube", link.media_id)
+    keyboard = mp3_keyboard("convert_mp3_youtube", unique_id)
 
-    if error:
-        await message.answer(error)
+    cache_key = link.key("video")
+    cached_file_id = file_cache.get(cache_key)
+    if cached_file_id and await file_cache.resend(
+        cache_key, cached_file_id,
+        lambda file_id: message.answer_video(video=file_id, caption=video_caption(username), reply_markup=keyboard)
+    ):
         return
 
-    try:
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🎵 Download in MP3", callback_data=f"convert_mp3_youtube|{unique_id}")]
-        ])
-        file_size = os.path.getsize(video_path)
-        if file_size > MAX_FILE_SIZE:
-            await message.answer("❌ File is so big.")
-            await safe_remove(video_path)
+    status = await message.answer("⏳ Downloading YouTube video...")
+    factory = lambda: scheduler.run(
+        "youtube", message.from_user.id, lambda: download_media(url, is_audio=False),
+        on_position=queue_status(status, "⏳ Downloading YouTube video...")
+    )
+    async with downloads.join(cache_key, factory, cleanup=lambda r: workspaces.release(r[0])) as flight:
+        video_path, info, error = flight.result
+
+        if error:
+            await finish_status(status, error)
+            return
+
+        # Sizes from metadata can be estimates; Telegram rejects anything over the limit.
+        if not fits(os.path.getsize(video_path)):
+            await finish_status(status, "❌ File is so big.")
             return
 
-        width, height = await get_clip_dimensions(video_path)
-        await message.answer_video(
-            video=FSInputFile(video_path),
-            caption=f"🔗 Download video 👉 @{bot_username}",
-            reply_markup=keyboard,
-            width=width,
-            height=height
-        )
-    finally:
-        await safe_remove(video_path)
+        width, height = await get_clip_dimensions(video_path, info)
+        async with flight.lock:
+            sent = await message.answer_video(
+                video=flight.file_id or input_file(video_path),
+                caption=video_caption(username),
+                reply_markup=keyboard,
+                width=width,
+                height=height
+            )
+            if not flight.file_id and sent.video:
+                flight.file_id = sent.video.file_id
+                file_cache.put(cache_key, flight.file_id)
+        await finish_status(status)
@@ -1,26 +1,50 @@
-import asyncio
 import os
-from aiogram import Bot, Dispatcher, Router, F
-from aiogram.enums import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.client.default import DefaultBotProperties
-from dotenv import load_dotenv
+import asyncio
 import logging
+from dotenv import load_dotenv
 
+# Before any services module reads its settings from the environment.
 load_dotenv()
 
-bot = Bot(token=os.getenv('BOT_TOKEN'))
-dp = Dispatcher()
-BOT_TOKEN = os.getenv('BOT_TOKEN')
-admin_id = os.getenv('ADMIN_ID')
+from services.startup import startup
+
+with startup.step("aiogram + core services"):
+    from services.app import App, create_app
+
 
-async def main():
-    import handlers
-    dp.include_router(handlers.router)
+async def main(app: App):
+    from services.cache import file_cache
+    from services.callbacks import callback_store
+    from services.http import close_clients
+    from services.metrics import start_metrics_server
+    from services.ui import load_bot_identity
+    from services.users import users
+    from services.workspace import workspaces
+    app.include_handlers()
 
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    await app.bot.delete_webhook(drop_pending_updates=True)
+    await load_bot_identity(app.bot)
+    # Single process: anything left in the workspace root is from a previous run.
+    workspaces.start_janitor(startup_max_age=0)
+    metrics_runner = await start_metrics_server()
+    startup.log()
+    try:
+        await app.dp.start_polling(app.bot)
+    finally:
+        await callback_store.close()
+        await file_cache.close()
+        await users.close()
+        workspaces.stop_janitor()
+        await close_clients()
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+    app = create_app()
+    if app.mode == "webhook":
+        from services.webhook import run_webhook
+        run_webhook(app)
+    else:
+        asyncio.run(main(app))
@@ -0,0 +1,60 @@
+import os
+
+from aiogram import Bot, Dispatcher
+
+from services.botapi import make_session
+from services.metrics import TelegramMetricsMiddleware
+from services.ratelimit import RateLimitMiddleware
+from services.startup import startup
+
+
+class App:
+    """
+    Єдиний контекст процесу: налаштування, Bot і Dispatcher.
+    Хендлери отримують його як аргумент `app` (а бота — як `bot`) через DI aiogram.
+    """
+
+    def __init__(self, token: str, admin_id: str | None = None, mode: str = "polling"):
+        self.token = token
+        self.admin_id = admin_id
+        self.mode = mode
+        self.bot = Bot(token=token, session=make_session())
+        # Pacing wraps the metrics middleware, so telegram/* latency excludes time spent queued.
+        self.bot.session.middleware(RateLimitMiddleware())
+        self.bot.session.middleware(TelegramMetricsMiddleware())
+        # Dispatcher keyword arguments become workflow data, injected into handlers by name.
+        self.dp = Dispatcher(app=self)
+        self._handlers = False
+
+    def is_admin(self, user_id: int) -> bool:
+        return bool(self.admin_id) and str(user_id) == str(self.admin_id)
+
+    def include_handlers(self):
+        if self._handlers:
+            return
+        with startup.step("handlers"):
+            import handlers
+        self.dp.include_router(handlers.router)
+        self._handlers = True
+
+
+_app: App | None = None
+
+
+def create_app() -> App:
+    """
+    Створює контекст процесу з оточення (один раз; повторні виклики повертають той самий).
+    """
+    global _app
+    if _app is None:
+        _app = App(os.getenv("BOT_TOKEN"), os.getenv("ADMIN_ID"), os.getenv("BOT_MODE", "polling"))
+    return _app
+
+
+def get_app() -> App:
+    """
+    Контекст для коду поза хендлерами (наприклад, колбеків yt-dlp у потоці).
+    """
+    if _app is None:
+        raise RuntimeError("create_app() has not been called")
+    return _app
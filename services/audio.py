@@ -0,0 +1,37 @@
+import os
+import asyncio
+import logging
+
+from services import probe
+from services.metrics import timed
+
+MP3_BITRATE = "192k"
+
+
+@timed("ffmpeg", "audio", error_of=lambda r: r)
+async def extract_audio(video_path: str, output_path: str, bitrate: str = MP3_BITRATE) -> str | None:
+    """
+    Витягує звукову доріжку з відео через ffmpeg без декодування відео.
+    Повертає текст помилки або None.
+    """
+    acodec = (await probe.probe_file(video_path)).acodec
+    if (output_path.endswith(".m4a") and acodec == "aac") or (output_path.endswith(".mp3") and acodec == "mp3"):
+        # The stream is already in the target codec: copy it as is.
+        codec_args = ["-c:a", "copy"]
+    else:
+        codec_args = ["-c:a", "libmp3lame", "-b:a", bitrate, "-ar", "44100"]
+
+    proc = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-nostdin", "-v", "error", "-y", "-i", video_path, "-vn", "-sn", "-dn",
+        *codec_args, output_path,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        error = stderr.decode(errors="ignore").strip() or f"ffmpeg exited with {proc.returncode}"
+        logging.error(f"Audio extraction failed for {video_path}: {error}")
+        return error
+    return None
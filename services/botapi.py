@@ -0,0 +1,53 @@
+import os
+import logging
+
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+from aiogram.types.input_file import FSInputFile
+
+# Optional local Bot API server (https://github.com/tdlib/telegram-bot-api).
+# Started with --local it accepts uploads up to 2000 MB, and on a filesystem it
+# shares with the bot, files are passed by path instead of uploaded.
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")
+TELEGRAM_API_LOCAL_FILES = os.getenv("TELEGRAM_API_LOCAL_FILES", "1") == "1"
+# "bot_dir:server_dir" when the shared volume is mounted at another path inside the server.
+TELEGRAM_API_PATH_MAP = os.getenv("TELEGRAM_API_PATH_MAP", "")
+
+LOCAL_API = bool(TELEGRAM_API_URL)
+PATH_UPLOADS = LOCAL_API and TELEGRAM_API_LOCAL_FILES
+LOCAL_UPLOAD_LIMIT_MB = 2000
+
+
+def api_server() -> TelegramAPIServer:
+    if not LOCAL_API:
+        return PRODUCTION
+    return TelegramAPIServer.from_base(TELEGRAM_API_URL, is_local=TELEGRAM_API_LOCAL_FILES)
+
+
+def make_session() -> AiohttpSession:
+    if LOCAL_API:
+        logging.info(f"Using local Bot API server {TELEGRAM_API_URL} (path uploads: {PATH_UPLOADS})")
+    return AiohttpSession(api=api_server())
+
+
+def _server_path(path: str) -> str | None:
+    if not TELEGRAM_API_PATH_MAP:
+        return path
+    bot_dir, _, server_dir = TELEGRAM_API_PATH_MAP.partition(":")
+    bot_dir = os.path.abspath(bot_dir)
+    if os.path.commonpath([bot_dir, path]) != bot_dir:
+        # Outside the shared volume: the server cannot see it.
+        return None
+    return server_dir.rstrip("/") + path[len(bot_dir):]
+
+
+def input_file(path: str) -> FSInputFile | str:
+    """
+    Файл для send*: `file://` шлях для локального сервера зі спільною ФС, інакше звичайне завантаження.
+    Файл має існувати, доки запит не завершиться.
+    """
+    if PATH_UPLOADS:
+        server_path = _server_path(os.path.abspath(path))
+        if server_path:
+            return f"file://{server_path}"
+    return FSInputFile(path)
@@ -0,0 +1,247 @@
+import os
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable
+
+from aiogram.exceptions import TelegramBadRequest
+
+from services import metrics
+from services.dp import DB_PATH, conn_bot
+
+# Telegram file_id cache: (platform, media id, format) -> file_id.
+# Rows live in the `search_cache` table (query = key, results = file_id,
+# timestamp = unix time of the last use), the hottest keys are mirrored in memory.
+FILE_ID_TTL = int(os.getenv("FILE_ID_CACHE_TTL", 7 * 24 * 3600))
+FILE_ID_MAX_ENTRIES = int(os.getenv("FILE_ID_CACHE_SIZE", 20000))
+FILE_ID_MEMORY_ENTRIES = 1024
+# Hits refresh `timestamp` in batches on a DB thread, so the TTL and the trim in
+# evict() follow real use and not only the hits that went past the memory tier.
+FILE_ID_TOUCH_INTERVAL = 30
+
+
+def make_key(platform: str, media_id: str, fmt: str) -> str:
+    return f"{platform}:{media_id}:{fmt}"
+
+
+class FileIdCache:
+    """
+    Пам'ять + SQLite. Читання йдуть через `conn`, а всі записи — в окремому потоці
+    з власним з'єднанням, щоб коміти (fsync, чужий write lock) не блокували event loop.
+    """
+
+    def __init__(self, conn, ttl: int = FILE_ID_TTL, max_entries: int = FILE_ID_MAX_ENTRIES,
+                 memory_entries: int = FILE_ID_MEMORY_ENTRIES, path: str = DB_PATH):
+        self._conn = conn
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self._memory: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        # Deleted keys whose DELETE has not been committed yet; reads must not bring them back.
+        self._deleting: dict[str, int] = {}
+        self._touched: dict[str, int] = {}
+        self._touch_handle: asyncio.TimerHandle | None = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="file-id-cache")
+        self._local = threading.local()
+        self._writing: set[asyncio.Future] = set()
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is None and key not in self._deleting:
+            entry = self._load(key)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        file_id, last_used = entry
+        if now - last_used > self.ttl:
+            self.delete(key)
+            self.misses += 1
+            return None
+
+        self._remember(key, file_id, now)
+        self._touch(key, now)
+        self.hits += 1
+        return file_id
+
+    async def resend(self, key: str, file_id: str, send: Callable[[str], Awaitable[Any]]) -> bool:
+        """
+        Надсилає закешований file_id через `send(file_id)`. Якщо Telegram його відхилив,
+        ключ видаляється і повертається False — тоді викликач завантажує медіа заново.
+        """
+        try:
+            await send(file_id)
+            return True
+        except TelegramBadRequest as e:
+            logging.warning(f"Cached file_id for {key} was rejected, downloading again: {e}")
+            self.delete(key)
+            return False
+
+    def put(self, key: str, file_id: str | None):
+        if not file_id:
+            return
+        now = time.time()
+        self._remember(key, file_id, now)
+        self._submit(self._put_row, key, file_id, int(now))
+
+        self._writes += 1
+        if self._writes % 500 == 0:
+            self.evict()
+
+    def delete(self, key: str):
+        self._memory.pop(key, None)
+        self._deleting[key] = self._deleting.get(key, 0) + 1
+        future = self._submit(self._delete_row, key)
+        if future is None:
+            self._deleted(key)
+        else:
+            future.add_done_callback(lambda _: self._deleted(key))
+
+    def _deleted(self, key: str):
+        self._deleting[key] -= 1
+        if not self._deleting[key]:
+            del self._deleting[key]
+
+    def evict(self):
+        """Drops expired rows and trims the table to the newest `max_entries` (on the DB thread)."""
+        self._submit(self._evict_rows)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+            "memory_entries": len(self._memory),
+        }
+
+    def _load(self, key: str) -> tuple[str, float] | None:
+        try:
+            row = self._conn.execute(
+                "SELECT results, timestamp FROM search_cache WHERE query = ?", (key,)
+            ).fetchone()
+        except Exception as e:
+            logging.error(f"file_id cache read failed: {e}")
+            return None
+        if not row or not row[0]:
+            return None
+        try:
+            last_used = float(row[1])
+        except (TypeError, ValueError):
+            last_used = 0.0
+        return row[0], last_used
+
+    # ------------------------- DB THREAD -------------------------
+
+    def _db(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            # WAL + NORMAL: a commit does not wait for fsync; losing the last writes only costs a re-upload.
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _put_row(self, key: str, file_id: str, timestamp: int):
+        with self._db() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO search_cache (query, results, timestamp) VALUES (?, ?, ?)",
+                (key, file_id, timestamp)
+            )
+
+    def _delete_row(self, key: str):
+        with self._db() as conn:
+            conn.execute("DELETE FROM search_cache WHERE query = ?", (key,))
+
+    def _evict_rows(self) -> int:
+        with self._db() as conn:
+            removed = conn.execute(
+                "DELETE FROM search_cache WHERE timestamp < ?", (int(time.time() - self.ttl),)
+            ).rowcount
+            removed += conn.execute(
+                "DELETE FROM search_cache WHERE query NOT IN "
+                "(SELECT query FROM search_cache ORDER BY timestamp DESC LIMIT ?)",
+                (self.max_entries,)
+            ).rowcount
+        return removed
+
+    def _write_touches(self, rows: list[tuple[int, str]]):
+        with self._db() as conn:
+            conn.executemany("UPDATE search_cache SET timestamp = ? WHERE query = ?", rows)
+
+    def _close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # ------------------------- WRITE-BEHIND -------------------------
+
+    def _submit(self, fn: Callable, *args) -> asyncio.Future | None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (startup, scripts): write straight away.
+            try:
+                fn(*args)
+            except Exception as e:
+                logging.error(f"file_id cache write failed: {e}")
+            return None
+        future = loop.run_in_executor(self._executor, fn, *args)
+        self._writing.add(future)
+        future.add_done_callback(self._written)
+        return future
+
+    def _written(self, future: asyncio.Future):
+        self._writing.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            logging.error(f"file_id cache write failed: {future.exception()}")
+
+    def _touch(self, key: str, now: float):
+        self._touched[key] = int(now)
+        if self._touch_handle is None:
+            try:
+                self._touch_handle = asyncio.get_running_loop().call_later(
+                    FILE_ID_TOUCH_INTERVAL, self.flush_touches
+                )
+            except RuntimeError:
+                self.flush_touches()
+
+    def flush_touches(self):
+        self._touch_handle = None
+        if not self._touched:
+            return
+        rows = [(timestamp, key) for key, timestamp in self._touched.items()]
+        self._touched = {}
+        self._submit(self._write_touches, rows)
+
+    async def close(self):
+        if self._touch_handle:
+            self._touch_handle.cancel()
+        self.flush_touches()
+        if self._writing:
+            await asyncio.gather(*self._writing, return_exceptions=True)
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close)
+        self._executor.shutdown(wait=True)
+
+    def _remember(self, key: str, file_id: str, last_used: float):
+        self._memory[key] = (file_id, last_used)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+
+file_cache = FileIdCache(conn_bot)
+metrics.gauge("downloader_file_id_cache_hits", "file_id cache hits.", lambda: file_cache.hits)
+metrics.gauge("downloader_file_id_cache_misses", "file_id cache misses.", lambda: file_cache.misses)
+file_cache.evict()
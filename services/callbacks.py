@@ -0,0 +1,184 @@
+import os
+import time
+import uuid
+import sqlite3
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from services.dp import DB_PATH, conn_bot
+
+# Shared store behind the "Download in MP3" buttons: bounded LRU + TTL in memory,
+# optionally written behind to the `callbacks` table so buttons survive restarts.
+CALLBACK_TTL = int(os.getenv("CALLBACK_TTL", 30 * 24 * 3600))
+CALLBACK_MEMORY_ENTRIES = int(os.getenv("CALLBACK_MEMORY_ENTRIES", 10000))
+CALLBACK_PERSIST = os.getenv("CALLBACK_PERSIST", "1") == "1"
+CALLBACK_FLUSH_INTERVAL = 2.0
+# Expired rows are purged with one of the flushes at most this often.
+CALLBACK_PURGE_INTERVAL = 3600
+
+
+class CallbackEntry:
+    __slots__ = ("url", "platform", "media_id", "file_id", "created")
+
+    def __init__(self, url: str, platform: str, media_id: str, file_id: str | None = None,
+                 created: float | None = None):
+        self.url = url
+        self.platform = platform
+        self.media_id = media_id
+        # file_id of the MP3 once it has been sent for this button
+        self.file_id = file_id
+        self.created = created or time.time()
+
+
+class CallbackStore:
+    def __init__(self, conn, ttl: int = CALLBACK_TTL, memory_entries: int = CALLBACK_MEMORY_ENTRIES,
+                 persist: bool = CALLBACK_PERSIST, path: str = DB_PATH):
+        self._conn = conn
+        self.path = path
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.persist = persist
+        self._entries: OrderedDict[str, CallbackEntry] = OrderedDict()
+        self._dirty: dict[str, CallbackEntry] = {}
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._purged_at = 0.0
+        # Writes go to their own thread and connection; reads stay on `conn`.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="callbacks-db")
+        self._local = threading.local()
+        self._writing: set[asyncio.Future] = set()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, url: str, platform: str, media_id: str) -> str:
+        token = uuid.uuid4().hex
+        entry = CallbackEntry(url, platform, media_id)
+        self._remember(token, entry)
+        self._mark_dirty(token, entry)
+        return token
+
+    def get(self, token: str) -> CallbackEntry | None:
+        entry = self._entries.get(token)
+        if entry is None and self.persist:
+            entry = self._load(token)
+        if entry is None:
+            return None
+        if time.time() - entry.created > self.ttl:
+            self._entries.pop(token, None)
+            return None
+        self._remember(token, entry)
+        return entry
+
+    def set_file_id(self, token: str, file_id: str | None):
+        entry = self.get(token)
+        if entry is None or not file_id:
+            return
+        entry.file_id = file_id
+        self._mark_dirty(token, entry)
+
+    def drop_file_id(self, token: str):
+        entry = self._entries.get(token)
+        if entry is None or not entry.file_id:
+            return
+        entry.file_id = None
+        self._mark_dirty(token, entry)
+
+    def flush(self) -> asyncio.Future | None:
+        self._flush_handle = None
+        if not self._dirty or not self.persist:
+            self._dirty.clear()
+            return None
+        rows = [(t, e.url, e.platform, e.media_id, e.file_id, e.created) for t, e in self._dirty.items()]
+        self._dirty.clear()
+        now = time.time()
+        purge_before = None
+        if now - self._purged_at >= CALLBACK_PURGE_INTERVAL:
+            self._purged_at = now
+            purge_before = now - self.ttl
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            try:
+                self._write(rows, purge_before)
+            except Exception as e:
+                logging.error(f"Callback store flush failed: {e}")
+            return None
+        future = loop.run_in_executor(self._executor, self._write, rows, purge_before)
+        self._writing.add(future)
+        future.add_done_callback(self._written)
+        return future
+
+    def _written(self, future: asyncio.Future):
+        self._writing.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            logging.error(f"Callback store flush failed: {future.exception()}")
+
+    async def close(self):
+        if self._flush_handle:
+            self._flush_handle.cancel()
+        self.flush()
+        if self._writing:
+            await asyncio.gather(*self._writing, return_exceptions=True)
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close)
+        self._executor.shutdown(wait=True)
+
+    def _mark_dirty(self, token: str, entry: CallbackEntry):
+        if not self.persist:
+            return
+        self._dirty[token] = entry
+        if self._flush_handle is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self.flush()
+                return
+            self._flush_handle = loop.call_later(CALLBACK_FLUSH_INTERVAL, self.flush)
+
+    def _load(self, token: str) -> CallbackEntry | None:
+        try:
+            row = self._conn.execute(
+                "SELECT url, platform, media_id, file_id, created FROM callbacks WHERE token = ?", (token,)
+            ).fetchone()
+        except Exception as e:
+            logging.error(f"Callback store read failed: {e}")
+            return None
+        return CallbackEntry(*row) if row else None
+
+    def _remember(self, token: str, entry: CallbackEntry):
+        self._entries[token] = entry
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.memory_entries:
+            self._entries.popitem(last=False)
+
+    # ------------------------- DB THREAD -------------------------
+
+    def _db(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _write(self, rows: list[tuple], purge_before: float | None):
+        with self._db() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO callbacks (token, url, platform, media_id, file_id, created) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            if purge_before is not None:
+                conn.execute("DELETE FROM callbacks WHERE created < ?", (purge_before,))
+
+    def _close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+callback_store = CallbackStore(conn_bot)
@@ -1,6 +1,11 @@
+import os
 import sqlite3
 
-conn_bot = sqlite3.connect('services/bot.db', check_same_thread=False)
+DB_PATH = os.getenv('DB_PATH', 'services/bot.db')
+
+conn_bot = sqlite3.connect(DB_PATH, check_same_thread=False)
+# WAL lets the user repository's writer thread commit without blocking readers.
+conn_bot.execute('PRAGMA journal_mode=WAL')
 cur_bot = conn_bot.cursor()
 
 # Таблиця користувачів
@@ -9,9 +14,17 @@ cur_bot.execute('''CREATE TABLE IF NOT EXISTS users (
     user_id INTEGER UNIQUE, 
     first_name TEXT, 
     last_name TEXT,
-    chat_id INTEGER
+    chat_id INTEGER,
+    last_seen REAL,
+    requests INTEGER DEFAULT 0
 )''')
 
+# Older databases were created without activity columns
+_user_columns = {row[1] for row in cur_bot.execute('PRAGMA table_info(users)')}
+for _column, _ddl in (('last_seen', 'REAL'), ('requests', 'INTEGER DEFAULT 0')):
+    if _column not in _user_columns:
+        cur_bot.execute(f'ALTER TABLE users ADD COLUMN {_column} {_ddl}')
+
 
 cur_bot.execute('''CREATE TABLE IF NOT EXISTS search_cache (
     query TEXT PRIMARY KEY,
@@ -20,4 +33,16 @@ cur_bot.execute('''CREATE TABLE IF NOT EXISTS search_cache (
 )
 ''')
 
+# Дані для inline-кнопок (MP3), щоб вони працювали після перезапуску
+cur_bot.execute('''CREATE TABLE IF NOT EXISTS callbacks (
+    token TEXT PRIMARY KEY,
+    url TEXT,
+    platform TEXT,
+    media_id TEXT,
+    file_id TEXT,
+    created REAL
+)
+''')
+cur_bot.execute('CREATE INDEX IF NOT EXISTS idx_callbacks_created ON callbacks(created)')
+
 conn_bot.commit()
\ No newline at end of file
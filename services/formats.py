@@ -0,0 +1,222 @@
+import os
+import asyncio
+import logging
+from functools import cache
+from typing import NamedTuple
+
+from services import probe
+from services.metrics import timed
+from services.resolve import MB, TELEGRAM_UPLOAD_LIMIT, MediaTooLarge, check_limits
+
+# What Telegram clients play inline: H.264 video and AAC audio in an MP4 whose
+# moov comes first. Formats are chosen to arrive that way; otherwise streams are
+# copied into a faststart MP4, and re-encoding is the last resort.
+# Every setting can be overridden per platform, e.g. FORMAT_MAX_HEIGHT_YOUTUBE=480.
+_DEFAULTS = {
+    "FORMAT_MAX_HEIGHT": 1080,
+    # Below this a progressive file loses to a merged one that is still within the limits.
+    "FORMAT_MIN_HEIGHT": 480,
+    "FORMAT_MAX_MB": 0,
+    "FORMAT_REENCODE": 1,
+}
+_PLATFORM_DEFAULTS = {
+    "youtube": {"FORMAT_MAX_HEIGHT": 720},
+}
+REENCODE_CRF = int(os.getenv("FORMAT_REENCODE_CRF", 23))
+REENCODE_PRESET = os.getenv("FORMAT_REENCODE_PRESET", "veryfast")
+
+# Passed to yt-dlp's merger, so merged downloads are faststart in the same ffmpeg pass.
+FASTSTART_MERGE_ARGS = {"merger+ffmpeg_o": ["-movflags", "+faststart"]}
+
+NO_ACTION, REMUX, REENCODE = "none", "remux", "reencode"
+
+
+class FormatPolicy(NamedTuple):
+    max_height: int
+    min_height: int
+    max_size: int
+    reencode: bool
+
+
+class FormatChoice(NamedTuple):
+    selector: str
+    size: int | None
+    # What still has to happen after the download: NO_ACTION, REMUX or REENCODE.
+    action: str
+
+
+def _setting(name: str, platform: str) -> int:
+    default = _PLATFORM_DEFAULTS.get(platform, {}).get(name, _DEFAULTS[name])
+    return int(os.getenv(f"{name}_{platform.upper()}", os.getenv(name, default)))
+
+
+@cache
+def policy_for(platform: str) -> FormatPolicy:
+    max_size = _setting("FORMAT_MAX_MB", platform) * MB
+    return FormatPolicy(
+        max_height=_setting("FORMAT_MAX_HEIGHT", platform),
+        min_height=_setting("FORMAT_MIN_HEIGHT", platform),
+        max_size=min(max_size, TELEGRAM_UPLOAD_LIMIT) if max_size else TELEGRAM_UPLOAD_LIMIT,
+        reencode=bool(_setting("FORMAT_REENCODE", platform)),
+    )
+
+
+def _codec(name: str | None) -> str | None:
+    return name.split(".")[0].lower() if name and name != "none" else None
+
+
+def is_h264(vcodec: str | None) -> bool:
+    return _codec(vcodec) in ("avc1", "avc3", "h264")
+
+
+def is_aac(acodec: str | None) -> bool:
+    return _codec(acodec) in ("mp4a", "aac")
+
+
+def playable(vcodec: str | None, acodec: str | None) -> bool:
+    return is_h264(vcodec) and (acodec is None or is_aac(acodec))
+
+
+def format_size(fmt: dict, duration: float | None) -> int | None:
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if not size and fmt.get("tbr") and duration:
+        size = int(fmt["tbr"] * 1000 / 8 * duration)
+    return size
+
+
+# ------------------------- SELECTION -------------------------
+
+class _Candidate(NamedTuple):
+    tier: int
+    selector: str
+    size: int
+    height: int
+    action: str
+
+
+def select_video(info: dict, policy: FormatPolicy) -> FormatChoice:
+    """
+    Формат yt-dlp за політикою: спершу готовий H.264/AAC mp4 (без ffmpeg), далі H.264 + AAC
+    для злиття без перекодування, і лише тоді інші кодеки. Найвища якість у межах висоти й розміру.
+    Кидає MediaTooLarge, якщо нічого не влазить.
+    """
+    duration = info.get("duration")
+    check_limits(duration=duration)
+    formats = info.get("formats") or []
+    audios = [f for f in formats if f.get("vcodec") == "none" and _codec(f.get("acodec"))]
+    audios.sort(key=lambda f: (is_aac(f.get("acodec")), f.get("abr") or 0), reverse=True)
+    best_audio = audios[0] if audios else None
+
+    candidates = []
+    for f in formats:
+        if not _codec(f.get("vcodec")):
+            continue
+        height = f.get("height") or 0
+        if height > policy.max_height:
+            continue
+        size = format_size(f, duration)
+        if _codec(f.get("acodec")):
+            selector, acodec = f["format_id"], f.get("acodec")
+        elif best_audio:
+            audio_size = format_size(best_audio, duration)
+            selector, acodec = f"{f['format_id']}+{best_audio['format_id']}", best_audio.get("acodec")
+            size = size + audio_size if size and audio_size else None
+        else:
+            continue
+        if not size:
+            continue
+
+        if playable(f.get("vcodec"), acodec) and "+" not in selector and f.get("ext") == "mp4":
+            tier, action = 0, NO_ACTION
+        elif playable(f.get("vcodec"), acodec):
+            tier, action = 1, REMUX
+        else:
+            tier, action = 2, REENCODE if policy.reencode else REMUX
+        candidates.append(_Candidate(tier, selector, size, height, action))
+
+    if not candidates:
+        # No usable size information (live, unusual extractors): let yt-dlp choose within the height.
+        height = policy.max_height
+        return FormatChoice(
+            f"bv*[height<={height}][vcodec^=avc1]+ba[ext=m4a]/b[height<={height}]/bv*+ba/b", None, REMUX
+        )
+
+    fitting = [c for c in candidates if c.size <= policy.max_size]
+    if not fitting:
+        smallest = min(c.size for c in candidates)
+        check_limits(size=smallest)
+        raise MediaTooLarge(f"❌ File is too big ({smallest // MB} MB, limit {policy.max_size // MB} MB).")
+    sharp = [c for c in fitting if c.height >= policy.min_height] or fitting
+    best = min(sharp, key=lambda c: (c.tier, -c.height, c.size))
+    return FormatChoice(best.selector, best.size, best.action)
+
+
+# ------------------------- POST-PROCESSING -------------------------
+
+async def _ffmpeg(args: list[str], output_path: str) -> str | None:
+    proc = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-nostdin", "-v", "error", "-y", *args, output_path,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        return stderr.decode(errors="ignore").strip() or f"ffmpeg exited with {proc.returncode}"
+    return None
+
+
+@timed("ffmpeg", "remux", error_of=lambda r: r)
+async def remux(path: str, output_path: str) -> str | None:
+    return await _ffmpeg(["-i", path, "-map", "0:v:0?", "-map", "0:a:0?", "-c", "copy",
+                          "-movflags", "+faststart"], output_path)
+
+
+@timed("ffmpeg", "reencode", error_of=lambda r: r)
+async def reencode(path: str, output_path: str, media: probe.MediaInfo, policy: FormatPolicy) -> str | None:
+    audio = ["-c:a", "copy"] if is_aac(media.acodec) else ["-c:a", "aac", "-b:a", "128k"]
+    return await _ffmpeg([
+        "-i", path, "-map", "0:v:0", "-map", "0:a:0?",
+        "-c:v", "libx264", "-preset", REENCODE_PRESET, "-crf", str(REENCODE_CRF), "-pix_fmt", "yuv420p",
+        "-vf", f"scale=-2:'min(ih,{policy.max_height})'",
+        *audio, "-movflags", "+faststart",
+    ], output_path)
+
+
+async def prepare_video(path: str, policy: FormatPolicy, workspace=None) -> str:
+    """
+    Доводить файл до вигляду, який Telegram відтворює одразу: без змін, якщо це вже
+    H.264/AAC mp4 з moov на початку; інакше копія потоків у mp4 з +faststart; перекодування —
+    лише коли кодеки не підходять і `policy.reencode`. Повертає шлях до готового файлу.
+    Якщо ffmpeg не впорався, повертає оригінал.
+    """
+    media = await probe.probe_file(path)
+    faststart = await asyncio.to_thread(probe.is_faststart, path)
+    if playable(media.vcodec, media.acodec) or not policy.reencode:
+        if faststart:
+            return path
+        action = REMUX
+    else:
+        action = REENCODE
+
+    if workspace is not None:
+        from services.workspace import workspaces
+        # Room for the converted copy next to the original.
+        await workspaces.admit(workspace, workspace.reserved + os.path.getsize(path))
+
+    base = os.path.splitext(path)[0]
+    output_path = f"{base}.{action}.mp4"
+    if action == REMUX:
+        error = await remux(path, output_path)
+    else:
+        error = await reencode(path, output_path, media, policy)
+    if error:
+        logging.warning(f"{action} of {path} failed, sending it as is: {error}")
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        return path
+
+    final_path = f"{base}.mp4"
+    os.replace(output_path, final_path)
+    if final_path != path:
+        os.remove(path)
+    return final_path
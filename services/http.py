@@ -0,0 +1,80 @@
+import os
+import asyncio
+import logging
+from urllib.parse import urlsplit
+
+import httpx
+import aiohttp
+
+# Shared HTTP clients, created lazily on first use and closed on shutdown.
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_PER_HOST = int(os.getenv("HTTP_MAX_PER_HOST", 16))
+HTTP_TIMEOUT = httpx.Timeout(30.0, connect=10.0)
+SESSION_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=10, sock_read=30)
+CHUNK_SIZE = 256 * 1024
+
+_client: httpx.AsyncClient | None = None
+_session: aiohttp.ClientSession | None = None
+_host_slots: dict[str, asyncio.Semaphore] = {}
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT,
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_CONNECTIONS // 2,
+            ),
+            headers={"User-Agent": "Mozilla/5.0"},
+        )
+    return _client
+
+
+def get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            timeout=SESSION_TIMEOUT,
+            connector=aiohttp.TCPConnector(limit=HTTP_MAX_CONNECTIONS, limit_per_host=HTTP_MAX_PER_HOST),
+        )
+    return _session
+
+
+def host_slot(url: str) -> asyncio.Semaphore:
+    """
+    Семафор, що обмежує кількість одночасних запитів до одного хоста.
+    """
+    host = urlsplit(url).hostname or ""
+    slot = _host_slots.get(host)
+    if slot is None:
+        slot = _host_slots[host] = asyncio.Semaphore(HTTP_MAX_PER_HOST)
+    return slot
+
+
+async def fetch_json(url: str, **kwargs) -> dict:
+    async with host_slot(url):
+        resp = await get_client().get(url, **kwargs)
+    resp.raise_for_status()
+    return resp.json()
+
+
+async def fetch_bytes(url: str, **kwargs) -> bytes:
+    async with host_slot(url):
+        resp = await get_client().get(url, **kwargs)
+    resp.raise_for_status()
+    return resp.content
+
+
+async def close_clients():
+    global _client, _session
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+        logging.info("HTTP client closed.")
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logging.info("aiohttp session closed.")
+    _client = None
+    _session = None
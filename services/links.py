@@ -0,0 +1,190 @@
+import os
+import re
+import logging
+from typing import Any, Awaitable, Callable, NamedTuple
+
+from aiogram import BaseMiddleware
+from aiogram.filters import Filter
+from aiogram.types import Message, TelegramObject
+
+from services import metrics
+from services.cache import make_key
+from services.singleflight import SingleFlight
+
+# Every supported link shape lives in one table, compiled into a single regex:
+# a message is parsed once and every handler and cache is keyed on the result.
+SHORTLINK_CACHE_TTL = int(os.getenv("SHORTLINK_CACHE_TTL", 6 * 3600))
+SHORTLINK_TIMEOUT = 10
+
+_YT = r"(?:www\.|m\.|music\.)?youtube\.com"
+_TT = r"(?:www\.|m\.)?tiktok\.com"
+_IG = r"(?:www\.)?instagram\.com"
+
+# (rule, platform, kind, pattern); `{id}` marks the media id. The first rule that matches wins.
+_RULES = (
+    ("yt_watch", "youtube", "video", _YT + r"/watch/?\?(?:[^#\s]*&)?v={id}"),
+    ("yt_shorts", "youtube", "shorts", _YT + r"/shorts/{id}"),
+    ("yt_embed", "youtube", "video", _YT + r"/(?:embed|live|v)/{id}"),
+    ("yt_short", "youtube", "video", r"youtu\.be/{id}"),
+    ("tt_video", "tiktok", "video", _TT + r"/@[^/\s?#]*/video/{id}"),
+    ("tt_photo", "tiktok", "photo", _TT + r"/@[^/\s?#]*/photo/{id}"),
+    ("tt_v", "tiktok", "video", _TT + r"/v/{id}"),
+    ("tt_short", "tiktok", "short", r"(?:(?:vm|vt)\.tiktok\.com|" + _TT + r"/t)/{id}"),
+    # Before the reel/post rules, which would take "share" for a user name.
+    ("ig_short", "instagram", "short", _IG + r"/share/(?:reel/|p/)?{id}"),
+    ("ig_reel", "instagram", "reel", _IG + r"/(?:[\w.]+/)?reels?/{id}"),
+    ("ig_post", "instagram", "post", _IG + r"/(?:[\w.]+/)?p/{id}"),
+)
+_ID_PATTERNS = {
+    "youtube": r"[\w-]{11}",
+    "tiktok": r"\d+",
+    "instagram": r"[\w-]+",
+}
+_SHORT_ID = r"[\w-]+"
+
+_TABLE = {rule: (platform, kind) for rule, platform, kind, _ in _RULES}
+# The host must not continue a longer name (notyoutube.com) and the id must end
+# where the path segment does, so 123abc is not read as the TikTok id 123.
+_PATTERN = re.compile(
+    r"(?:https?://)?(?<![\w.-])(?:" + "|".join(
+        f"(?P<{rule}>" + pattern.format(
+            id=f"(?P<{rule}_id>{_SHORT_ID if kind == 'short' else _ID_PATTERNS[platform]})(?![\w-])"
+        ) + ")"
+        for rule, platform, kind, pattern in _RULES
+    ) + r")",
+    re.IGNORECASE,
+)
+
+_CANONICAL_URLS = {
+    "youtube": "https://www.youtube.com/watch?v={id}",
+    "instagram": "https://www.instagram.com/reel/{id}/",
+}
+
+
+class Link(NamedTuple):
+    platform: str
+    media_id: str
+    # video, shorts, photo, reel, post, or short for a not yet expanded short link
+    kind: str
+    url: str
+
+    def key(self, fmt: str) -> str:
+        return make_key(self.platform, self.media_id, fmt)
+
+
+def classify(text: str | None) -> Link | None:
+    """
+    Перше посилання на підтримувану платформу в тексті: (платформа, канонічний id, вид, URL).
+    Короткі посилання повертаються з kind="short" — їх розгортає `expand`.
+    """
+    if not text:
+        return None
+    match = _PATTERN.search(text)
+    if not match:
+        return None
+    rule = match.lastgroup
+    platform, kind = _TABLE[rule]
+    media_id = match.group(f"{rule}_id")
+    template = _CANONICAL_URLS.get(platform) if kind != "short" else None
+    if template:
+        url = template.format(id=media_id)
+    else:
+        # TikTok pages need the original path (user name); drop the query and fragment.
+        url = match.group(rule)
+        url = url if url.lower().startswith("http") else f"https://{url}"
+    return Link(platform, media_id, kind, url)
+
+
+_expansions = SingleFlight()
+
+
+async def _follow(url: str) -> str:
+    from services.http import get_client, host_slot
+
+    async with host_slot(url):
+        resp = await get_client().head(url, follow_redirects=True, timeout=SHORTLINK_TIMEOUT)
+        if resp.status_code >= 400:
+            # Some shorteners refuse HEAD; the body of a GET is never read.
+            async with get_client().stream("GET", url, follow_redirects=True, timeout=SHORTLINK_TIMEOUT) as resp:
+                pass
+    return str(resp.url)
+
+
+async def expand(link: Link) -> Link:
+    """
+    Розгортає коротке посилання через HEAD-редиректи (результат кешується на SHORTLINK_CACHE_TTL).
+    Якщо не вдалося — повертає посилання як є.
+    """
+    if link.kind != "short":
+        return link
+    try:
+        async with _expansions.join(link.key("short"), lambda: _follow(link.url),
+                                    linger=SHORTLINK_CACHE_TTL) as flight:
+            target = flight.result
+    except Exception as e:
+        logging.warning(f"Cannot expand {link.url}: {e}")
+        _expansions.forget(link.key("short"))
+        return link
+    expanded = classify(target)
+    if expanded is None or expanded.platform != link.platform or expanded.kind == "short":
+        return link
+    return expanded
+
+
+def expanded(link: Link) -> Link:
+    """
+    Розгорнуте посилання, якщо `expand` для нього вже відпрацював; без мережі і без очікування.
+    """
+    if link.kind != "short":
+        return link
+    target = _expansions.peek(link.key("short"))
+    expanded_link = classify(target) if target else None
+    if expanded_link is None or expanded_link.platform != link.platform or expanded_link.kind == "short":
+        return link
+    return expanded_link
+
+
+def extract_media_id(platform: str, url: str) -> str:
+    """
+    Канонічний id медіа з URL (або сам URL без query, якщо посилання не розпізнано).
+    """
+    link = classify(url)
+    if link and link.platform == platform:
+        return link.media_id
+    return url.strip().split("?")[0].rstrip("/")
+
+
+async def parse(text: str | None) -> Link | None:
+    link = classify(text)
+    return await expand(link) if link else None
+
+
+class LinkMiddleware(BaseMiddleware):
+    """
+    Розбирає посилання з повідомлення один раз і передає хендлерам як `link`.
+    """
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        if isinstance(event, Message):
+            data["link"] = await parse(event.text)
+        return await handler(event, data)
+
+
+class LinkFilter(Filter):
+    """
+    Пропускає повідомлення з посиланням на `platform` (і одного з `kinds`, якщо задано).
+    Потребує LinkMiddleware.
+    """
+
+    def __init__(self, platform: str, kinds: tuple[str, ...] = ()):
+        self.platform = platform
+        self.kinds = kinds
+
+    async def __call__(self, message: Message, link: Link | None = None) -> bool:
+        if link is None or link.platform != self.platform:
+            return False
+        return not self.kinds or link.kind in self.kinds
+
+
+metrics.gauge("downloader_shortlink_cache_entries", "Expanded short links kept in memory.", _expansions.in_flight)
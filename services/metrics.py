@@ -0,0 +1,205 @@
+import os
+import time
+import bisect
+import logging
+import functools
+from collections import deque
+from typing import Any, Callable
+
+from aiohttp import web
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+# Per-stage latency/size histograms, outcome counters and scrape-time gauges,
+# exposed in the Prometheus text format on METRICS_HOST:METRICS_PORT/metrics.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+BYTES_BUCKETS = tuple(2 ** n * 1024 for n in range(0, 22, 2))  # 1 KB .. 2 GB
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "total", "count", "recent")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+        # Recent raw samples for the percentiles shown by /stats
+        self.recent: deque[float] = deque(maxlen=512)
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantile(self, q: float) -> float | None:
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+_latency: dict[tuple[str, str], Histogram] = {}
+_sizes: dict[tuple[str, str], Histogram] = {}
+_outcomes: dict[tuple[str, str, str], int] = {}
+_gauges: dict[str, tuple[str, Callable[[], float]]] = {}
+
+
+def observe(stage: str, platform: str, seconds: float, outcome: str = "ok", size: int | None = None):
+    key = (stage, platform)
+    hist = _latency.get(key)
+    if hist is None:
+        hist = _latency[key] = Histogram(LATENCY_BUCKETS)
+    hist.observe(seconds)
+    if size:
+        sizes = _sizes.get(key)
+        if sizes is None:
+            sizes = _sizes[key] = Histogram(BYTES_BUCKETS)
+        sizes.observe(size)
+    outcome_key = (stage, platform, outcome)
+    _outcomes[outcome_key] = _outcomes.get(outcome_key, 0) + 1
+
+
+def gauge(name: str, help_text: str, fn: Callable[[], float]):
+    _gauges[name] = (help_text, fn)
+
+
+def timed(stage: str, platform: str, error_of: Callable[[Any], Any] | None = None,
+          size_of: Callable[[Any], int | None] | None = None):
+    """
+    Декоратор для async-функцій конвеєра: час, розмір результату та результат (ok/помилка).
+    `error_of(result)` повертає помилку для функцій, що повертають її замість винятку.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                observe(stage, platform, time.monotonic() - started, type(e).__name__)
+                raise
+            outcome = "error" if error_of and error_of(result) else "ok"
+            size = None
+            if outcome == "ok" and size_of:
+                try:
+                    size = size_of(result)
+                except Exception:
+                    size = None
+            observe(stage, platform, time.monotonic() - started, outcome, size)
+            return result
+        return wrapper
+    return decorator
+
+
+def file_size(path) -> int | None:
+    if isinstance(path, (list, tuple)):
+        return sum(os.path.getsize(p) for p in path if p and os.path.exists(p)) or None
+    return os.path.getsize(path) if path and os.path.exists(path) else None
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """
+    Час кожного виклику Bot API (sendVideo, sendAudio, editMessageText, ...).
+    """
+
+    async def __call__(self, make_request, bot, method):
+        started = time.monotonic()
+        name = type(method).__name__
+        try:
+            response = await make_request(bot, method)
+        except Exception as e:
+            observe("telegram", name, time.monotonic() - started, type(e).__name__)
+            raise
+        observe("telegram", name, time.monotonic() - started)
+        return response
+
+
+# ------------------------- EXPOSITION -------------------------
+
+def _labels(**labels) -> str:
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+def _render_histogram(lines: list[str], name: str, series: dict[tuple[str, str], Histogram]):
+    for (stage, platform), hist in sorted(series.items()):
+        cumulative = 0
+        for bound, count in zip(hist.buckets + (float("inf"),), hist.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else bound
+            lines.append(f"{name}_bucket{_labels(stage=stage, platform=platform, le=le)} {cumulative}")
+        lines.append(f"{name}_sum{_labels(stage=stage, platform=platform)} {hist.total}")
+        lines.append(f"{name}_count{_labels(stage=stage, platform=platform)} {hist.count}")
+
+
+def render() -> str:
+    lines = [
+        "# HELP downloader_stage_seconds Pipeline stage latency.",
+        "# TYPE downloader_stage_seconds histogram",
+    ]
+    _render_histogram(lines, "downloader_stage_seconds", _latency)
+    lines += [
+        "# HELP downloader_stage_bytes Bytes produced by a pipeline stage.",
+        "# TYPE downloader_stage_bytes histogram",
+    ]
+    _render_histogram(lines, "downloader_stage_bytes", _sizes)
+    lines += [
+        "# HELP downloader_stage_total Pipeline stage outcomes.",
+        "# TYPE downloader_stage_total counter",
+    ]
+    for (stage, platform, outcome), count in sorted(_outcomes.items()):
+        lines.append(f"downloader_stage_total{_labels(stage=stage, platform=platform, outcome=outcome)} {count}")
+    for name, (help_text, fn) in sorted(_gauges.items()):
+        try:
+            value = fn()
+        except Exception as e:
+            logging.debug(f"Gauge {name} failed: {e}")
+            continue
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+def summary() -> str:
+    """
+    Короткий текстовий звіт для команди /stats.
+    """
+    lines = []
+    for (stage, platform), hist in sorted(_latency.items()):
+        errors = sum(c for (s, p, o), c in _outcomes.items() if s == stage and p == platform and o != "ok")
+        p50, p95 = hist.quantile(0.5), hist.quantile(0.95)
+        lines.append(f"{stage}/{platform}: n={hist.count} err={errors} p50={p50:.2f}s p95={p95:.2f}s")
+    for name, (_, fn) in sorted(_gauges.items()):
+        try:
+            lines.append(f"{name}: {fn()}")
+        except Exception:
+            pass
+    return "\n".join(lines) or "No data yet."
+
+
+def percentiles(qs: tuple[float, ...] = (0.5, 0.95, 0.99)) -> dict[tuple[str, str], dict]:
+    """
+    Кількість і перцентилі латентності для кожної пари (stage, platform), за останніми вибірками.
+    """
+    return {
+        key: {"n": hist.count, **{f"p{round(q * 100)}": hist.quantile(q) for q in qs}}
+        for key, hist in sorted(_latency.items())
+    }
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> web.AppRunner | None:
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Metrics available on http://{host}:{port}/metrics")
+    return runner
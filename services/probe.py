@@ -0,0 +1,268 @@
+import os
+import json
+import struct
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import NamedTuple
+
+from services.metrics import timed
+
+
+class MediaInfo(NamedTuple):
+    width: int | None = None
+    height: int | None = None
+    duration: float | None = None
+    vcodec: str | None = None
+    acodec: str | None = None
+
+
+PROBE_CACHE_SIZE = 512
+MAX_MOOV_SIZE = 32 * 1024 * 1024
+
+_cache: OrderedDict[tuple, MediaInfo] = OrderedDict()
+
+
+def from_info(info: dict | None) -> MediaInfo:
+    """
+    Бере розміри, тривалість і кодеки з info-словника yt-dlp (без читання файлу).
+    """
+    if not info:
+        return MediaInfo()
+    vcodec = info.get("vcodec")
+    acodec = info.get("acodec")
+    return MediaInfo(
+        width=info.get("width"),
+        height=info.get("height"),
+        duration=info.get("duration"),
+        vcodec=None if vcodec == "none" else vcodec,
+        acodec=None if acodec == "none" else acodec,
+    )
+
+
+@timed("probe", "file")
+async def probe_file(path: str) -> MediaInfo:
+    """
+    Читає метадані файлу: спочатку з MP4 `moov`, інакше одним викликом ffprobe.
+    Результат кешується за (шлях, розмір, mtime).
+    """
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        logging.error(f"Cannot probe {path}: {e}")
+        return MediaInfo()
+
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    cached = _cache.get(key)
+    if cached is not None:
+        _cache.move_to_end(key)
+        return cached
+
+    media = None
+    try:
+        media = await asyncio.to_thread(_parse_mp4, path)
+    except Exception as e:
+        logging.debug(f"MP4 box parse failed for {path}: {e}")
+    if media is None or (media.vcodec and not media.width):
+        media = await _ffprobe(path) or media or MediaInfo()
+
+    _cache[key] = media
+    while len(_cache) > PROBE_CACHE_SIZE:
+        _cache.popitem(last=False)
+    return media
+
+
+async def probe(path: str | None = None, info: dict | None = None) -> MediaInfo:
+    media = from_info(info)
+    if (media.width and media.height and media.duration) or not path:
+        return media
+    probed = await probe_file(path)
+    # yt-dlp values win, the file fills the gaps
+    return MediaInfo(*(a if a is not None else b for a, b in zip(media, probed)))
+
+
+async def get_video_size(path: str, info: dict | None = None) -> tuple[int | None, int | None]:
+    media = await probe(path, info)
+    return media.width, media.height
+
+
+async def get_duration(path: str, info: dict | None = None) -> float | None:
+    media = await probe(path, info)
+    return media.duration
+
+
+# ------------------------- FFPROBE -------------------------
+
+async def _ffprobe(path: str) -> MediaInfo | None:
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "error",
+            "-show_entries", "stream=codec_type,codec_name,width,height:format=duration",
+            "-of", "json", path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        stdout, _ = await proc.communicate()
+        if proc.returncode != 0:
+            return None
+        data = json.loads(stdout or b"{}")
+    except Exception as e:
+        logging.error(f"ffprobe failed for {path}: {e}")
+        return None
+
+    width = height = vcodec = acodec = None
+    for stream in data.get("streams", []):
+        if stream.get("codec_type") == "video" and vcodec is None:
+            vcodec = stream.get("codec_name")
+            width, height = stream.get("width"), stream.get("height")
+        elif stream.get("codec_type") == "audio" and acodec is None:
+            acodec = stream.get("codec_name")
+    duration = data.get("format", {}).get("duration")
+    return MediaInfo(width, height, float(duration) if duration else None, vcodec, acodec)
+
+
+# ------------------------- MP4 BOXES -------------------------
+
+_CONTAINERS = {b"trak", b"mdia", b"minf", b"stbl"}
+_CODEC_NAMES = {
+    b"avc1": "h264", b"avc3": "h264", b"hvc1": "hevc", b"hev1": "hevc",
+    b"av01": "av1", b"vp09": "vp9", b"mp4a": "aac", b"Opus": "opus", b".mp3": "mp3",
+}
+
+
+def _iter_boxes(data: bytes, start: int = 0, end: int | None = None):
+    end = len(data) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            return
+        yield box_type, pos + header, min(pos + size, end)
+        pos += size
+
+
+def _top_level_boxes(f):
+    # Top-level boxes are walked by their headers only, so a trailing moov
+    # (no faststart) costs a seek over mdat, not a read.
+    file_size = os.fstat(f.fileno()).st_size
+    pos = 0
+    while pos + 8 <= file_size:
+        f.seek(pos)
+        header = f.read(16)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack_from(">I4s", header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", header, 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = file_size - pos
+        if size < header_size:
+            return
+        yield box_type, pos + header_size, size - header_size
+        pos += size
+
+
+def _read_moov(path: str) -> bytes | None:
+    with open(path, "rb") as f:
+        for box_type, start, length in _top_level_boxes(f):
+            if box_type == b"moov":
+                if length > MAX_MOOV_SIZE:
+                    return None
+                f.seek(start)
+                return f.read(length)
+    return None
+
+
+def is_faststart(path: str) -> bool | None:
+    """
+    True, якщо `moov` стоїть перед `mdat` (Telegram може почати відтворення до кінця завантаження).
+    None — файл не MP4.
+    """
+    try:
+        with open(path, "rb") as f:
+            for box_type, _, _ in _top_level_boxes(f):
+                if box_type == b"moov":
+                    return True
+                if box_type == b"mdat":
+                    return False
+    except OSError as e:
+        logging.debug(f"Cannot read boxes of {path}: {e}")
+    return None
+
+
+def parse_head(data: bytes) -> MediaInfo | None:
+    """
+    Метадані з перших байтів MP4, якщо `moov` стоїть перед `mdat` і цілком вміщається в `data`.
+    None — moov далі (немає faststart), обрізаний або це не MP4.
+    """
+    pos = 0
+    while pos + 8 <= len(data):
+        size, box_type = struct.unpack_from(">I4s", data, pos)
+        header = 8
+        if size == 1 and pos + 16 <= len(data):
+            size = struct.unpack_from(">Q", data, pos + 8)[0]
+            header = 16
+        if size < header or box_type == b"mdat" or pos + size > len(data):
+            return None
+        if box_type == b"moov":
+            return _parse_moov(data[pos + header:pos + size])
+        pos += size
+    return None
+
+
+def _parse_mp4(path: str) -> MediaInfo | None:
+    moov = _read_moov(path)
+    if moov is None:
+        return None
+    return _parse_moov(moov)
+
+
+def _parse_moov(moov: bytes) -> MediaInfo:
+    duration = None
+    width = height = vcodec = acodec = None
+    for box_type, start, end in _iter_boxes(moov):
+        if box_type == b"mvhd":
+            version = moov[start]
+            if version == 1:
+                timescale, length = struct.unpack_from(">IQ", moov, start + 20)
+            else:
+                timescale, length = struct.unpack_from(">II", moov, start + 12)
+            if timescale:
+                duration = length / timescale
+        elif box_type == b"trak":
+            track = _parse_trak(moov, start, end)
+            if track["handler"] == b"vide" and vcodec is None:
+                vcodec = track["codec"]
+                width, height = track["width"], track["height"]
+            elif track["handler"] == b"soun" and acodec is None:
+                acodec = track["codec"]
+
+    return MediaInfo(width, height, duration, vcodec, acodec)
+
+
+def _parse_trak(data: bytes, start: int, end: int) -> dict:
+    track = {"handler": None, "codec": None, "width": None, "height": None}
+    stack = [(start, end)]
+    while stack:
+        box_start, box_end = stack.pop()
+        for box_type, payload, payload_end in _iter_boxes(data, box_start, box_end):
+            if box_type in _CONTAINERS:
+                stack.append((payload, payload_end))
+            elif box_type == b"tkhd":
+                offset = 88 if data[payload] == 1 else 76
+                w, h = struct.unpack_from(">II", data, payload + offset)
+                track["width"], track["height"] = (w >> 16) or None, (h >> 16) or None
+            elif box_type == b"hdlr":
+                track["handler"] = data[payload + 8:payload + 12]
+            elif box_type == b"stsd":
+                fourcc = data[payload + 12:payload + 16]
+                track["codec"] = _CODEC_NAMES.get(fourcc, fourcc.decode("latin-1").strip() or None)
+    return track
@@ -0,0 +1,262 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable
+
+from services import metrics
+
+# Metadata for a platform comes from an ordered list of backends (tikwm, then yt-dlp).
+# Each backend keeps a rolling window of latencies and outcomes; consecutive failures
+# open its circuit breaker, and a request still running past the backend's p95 gets
+# a hedged second request to the next backend. The first answer wins.
+PROVIDER_TIMEOUT = float(os.getenv("PROVIDER_TIMEOUT", 20))
+PROVIDER_WINDOW = int(os.getenv("PROVIDER_WINDOW", 100))
+PROVIDER_BREAKER_FAILURES = int(os.getenv("PROVIDER_BREAKER_FAILURES", 5))
+PROVIDER_BREAKER_COOLDOWN = float(os.getenv("PROVIDER_BREAKER_COOLDOWN", 30))
+# A backend failing this share of its recent attempts is tried after the healthy ones.
+# Only the last PROVIDER_HEALTH_WINDOW seconds count, so a demoted backend gets its turn back.
+PROVIDER_DEGRADED_ERROR_RATE = float(os.getenv("PROVIDER_DEGRADED_ERROR_RATE", 0.5))
+PROVIDER_HEALTH_WINDOW = float(os.getenv("PROVIDER_HEALTH_WINDOW", 120))
+HEALTH_MIN_SAMPLES = 5
+PROVIDER_HEDGE = os.getenv("PROVIDER_HEDGE", "1") == "1"
+# Hedge delay until a backend has enough samples for its own p95.
+PROVIDER_HEDGE_DELAY = float(os.getenv("PROVIDER_HEDGE_DELAY", 3))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = 0.25
+# Blocking backends (instaloader, yt-dlp) get their own bounded pool: a timed-out
+# attempt keeps its thread until the library returns, and with the default executor
+# stuck calls would starve file I/O and everything else that runs in threads.
+PROVIDER_THREADS = int(os.getenv("PROVIDER_THREADS", 8))
+
+_executor = ThreadPoolExecutor(max_workers=PROVIDER_THREADS, thread_name_prefix="provider")
+
+
+async def run_blocking(fn: Callable[..., Any], *args) -> Any:
+    """
+    Виконує блокуючий виклик бекенда в пулі PROVIDER_THREADS потоків.
+    """
+    return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+
+
+class NotFound(Exception):
+    """
+    Бекенд відповів, але медіа немає (видалене, приватне, не відео). Бекенд при цьому здоровий.
+    """
+
+
+class ProviderError(Exception):
+    """
+    Жоден бекенд не відповів. Текст — помилка першого з них, `errors` — усі.
+    """
+
+    def __init__(self, errors: list[tuple[str, Exception]]):
+        super().__init__(str(errors[0][1]) if errors else "no backends configured")
+        self.errors = errors
+
+
+class Backend:
+    """
+    Одне джерело метаданих: ковзне вікно латентностей і помилок та circuit breaker
+    (closed → open після PROVIDER_BREAKER_FAILURES помилок поспіль → half-open з однією пробою).
+    """
+
+    def __init__(self, platform: str, name: str, fetch: Callable[[str], Awaitable[Any]],
+                 timeout: float = PROVIDER_TIMEOUT):
+        self.platform = platform
+        self.name = name
+        self.fetch = fetch
+        self.timeout = timeout
+        self.latencies: deque[float] = deque(maxlen=PROVIDER_WINDOW)
+        # (monotonic time, failed)
+        self.outcomes: deque[tuple[float, bool]] = deque(maxlen=PROVIDER_WINDOW)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    def error_rate(self, now: float) -> float:
+        recent = [failed for at, failed in self.outcomes if now - at < PROVIDER_HEALTH_WINDOW]
+        return sum(recent) / len(recent) if recent else 0.0
+
+    def degraded(self, now: float) -> bool:
+        recent = sum(1 for at, _ in self.outcomes if now - at < PROVIDER_HEALTH_WINDOW)
+        return recent >= HEALTH_MIN_SAMPLES and self.error_rate(now) >= PROVIDER_DEGRADED_ERROR_RATE
+
+    def p95(self) -> float | None:
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+
+    def hedge_delay(self) -> float:
+        p95 = self.p95()
+        return max(HEDGE_MIN_DELAY, min(p95, self.timeout)) if p95 is not None else PROVIDER_HEDGE_DELAY
+
+    def state(self, now: float) -> str:
+        if not self.open_until:
+            return "closed"
+        return "open" if now < self.open_until else "half-open"
+
+    def available(self, now: float) -> bool:
+        state = self.state(now)
+        return state == "closed" or (state == "half-open" and not self.probing)
+
+    def _record(self, seconds: float, outcome: str, failed: bool | None):
+        self.latencies.append(seconds)
+        if failed is not None:
+            self.outcomes.append((time.monotonic(), failed))
+        metrics.observe("provider", f"{self.platform}/{self.name}", seconds, outcome)
+
+    def succeeded(self, seconds: float, outcome: str = "ok"):
+        self._record(seconds, outcome, False)
+        self.consecutive_failures = 0
+        if self.open_until:
+            logging.info(f"{self.platform}/{self.name}: circuit closed")
+        self.open_until = 0.0
+        self.probing = False
+
+    def failed_with(self, seconds: float, error: Exception):
+        self._record(seconds, type(error).__name__, True)
+        self.consecutive_failures += 1
+        if self.probing or self.consecutive_failures >= PROVIDER_BREAKER_FAILURES:
+            if self.state(time.monotonic()) != "open":
+                logging.warning(f"{self.platform}/{self.name}: circuit open for {PROVIDER_BREAKER_COOLDOWN:.0f}s "
+                                f"after {self.consecutive_failures} failures ({error})")
+            self.open_until = time.monotonic() + PROVIDER_BREAKER_COOLDOWN
+        self.probing = False
+
+    def cancelled(self, seconds: float):
+        # Lost a hedge race: the elapsed time is a lower bound of its latency, and
+        # keeping it stops the p95 from drifting down to only the fast answers.
+        self._record(seconds, "cancelled", None)
+        self.probing = False
+
+
+class Provider:
+    """
+    Упорядкований список бекендів однієї платформи з failover і hedged-запитами.
+    """
+
+    def __init__(self, platform: str, backends: list[Backend]):
+        self.platform = platform
+        self.backends = backends
+        _providers.append(self)
+
+    def ranked(self, now: float) -> list[Backend]:
+        """
+        Доступні бекенди: спершу здорові, потім деградовані, у порядку налаштувань.
+        Якщо всі розімкнені — той, чий breaker закриється найраніше (як проба).
+        """
+        available = [b for b in self.backends if b.available(now)]
+        if not available:
+            return [min(self.backends, key=lambda b: b.open_until)] if self.backends else []
+        return sorted(available, key=lambda b: b.degraded(now))
+
+    async def _attempt(self, backend: Backend, url: str) -> Any:
+        started = time.monotonic()
+        if backend.state(started) != "closed":
+            backend.probing = True
+        try:
+            result = await asyncio.wait_for(backend.fetch(url), backend.timeout)
+        except asyncio.CancelledError:
+            backend.cancelled(time.monotonic() - started)
+            raise
+        except NotFound:
+            backend.succeeded(time.monotonic() - started, "not_found")
+            raise
+        except Exception as e:
+            backend.failed_with(time.monotonic() - started, e)
+            raise
+        backend.succeeded(time.monotonic() - started)
+        return result
+
+    async def resolve(self, url: str) -> Any:
+        """
+        Перша успішна відповідь. Бекенд, що впав, одразу передає запит наступному; той, що
+        відповідає довше за свій p95, отримує паралельний (hedged) запит до наступного.
+        Кидає ProviderError, якщо не вдалося жодному.
+        """
+        candidates = iter(self.ranked(time.monotonic()))
+        pending: dict[asyncio.Task, Backend] = {}
+        errors: list[tuple[str, Exception]] = []
+        hedged = False
+
+        def launch() -> Backend | None:
+            backend = next(candidates, None)
+            if backend is not None:
+                pending[asyncio.ensure_future(self._attempt(backend, url))] = backend
+            return backend
+
+        latest = launch()
+        try:
+            while pending:
+                delay = latest.hedge_delay() if PROVIDER_HEDGE and not hedged else None
+                done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    hedge = launch()
+                    if hedge is not None:
+                        latest = hedge
+                        metrics.observe("hedge", f"{self.platform}/{hedge.name}", delay)
+                    continue
+
+                winner = None
+                for task in done:
+                    backend = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        errors.append((backend.name, e))
+                        continue
+                    if winner is None:
+                        winner = backend, result
+                if winner is not None:
+                    if errors or len(done) > 1 or hedged:
+                        logging.info(f"{self.platform}: answered by {winner[0].name}")
+                    return winner[1]
+                if not pending:
+                    latest = launch() or latest
+        finally:
+            for task in pending:
+                task.cancel()
+
+        for name, error in errors:
+            logging.warning(f"{self.platform}/{name} failed for {url}: {error!r}")
+        raise ProviderError(errors)
+
+
+_providers: list[Provider] = []
+
+
+def backends_from_env(platform: str, available: dict[str, Callable[[str], Awaitable[Any]]],
+                      default: str) -> list[Backend]:
+    """
+    Бекенди з {PLATFORM}_BACKENDS (через кому, у порядку спроб); невідомі імена пропускаються.
+    """
+    names = [n.strip() for n in os.getenv(f"{platform.upper()}_BACKENDS", default).split(",") if n.strip()]
+    unknown = [n for n in names if n not in available]
+    if unknown:
+        logging.warning(f"Unknown {platform} backends ignored: {', '.join(unknown)}")
+    return [Backend(platform, n, available[n]) for n in names if n in available]
+
+
+def summary() -> str:
+    """
+    Стан бекендів для /stats.
+    """
+    now = time.monotonic()
+    lines = []
+    for provider in _providers:
+        for b in provider.backends:
+            p95 = b.p95()
+            lines.append(f"{provider.platform}/{b.name}: {b.state(now)} err={b.error_rate(now):.0%} "
+                         f"p95={'n/a' if p95 is None else f'{p95:.2f}s'}")
+    return "\n".join(lines) or "No providers."
+
+
+metrics.gauge(
+    "downloader_provider_breakers_open", "Backends whose circuit breaker is open.",
+    lambda: sum(b.state(time.monotonic()) == "open" for p in _providers for b in p.backends),
+)
@@ -0,0 +1,176 @@
+import os
+import random
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+import httpx
+
+from services.http import CHUNK_SIZE, get_client, host_slot
+
+# Direct media files are fetched as N parallel byte ranges into a preallocated
+# file. A failed range is retried from the last byte written, not from zero.
+DOWNLOAD_SEGMENTS = int(os.getenv("DOWNLOAD_SEGMENTS", 4))
+DOWNLOAD_SEGMENT_MIN_SIZE = int(os.getenv("DOWNLOAD_SEGMENT_MIN_MB", 4)) * 1024 * 1024
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", 4))
+DOWNLOAD_BACKOFF = 0.5
+DOWNLOAD_TIMEOUT = httpx.Timeout(30.0, connect=10.0)
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+class _Segment:
+    __slots__ = ("start", "end", "offset")
+
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.end = end
+        # Next byte to fetch; the segment is done once it passes `end`.
+        self.offset = start
+
+    @property
+    def done(self) -> bool:
+        return self.offset > self.end
+
+
+def _plan(total: int, segments: int) -> list[_Segment]:
+    count = max(1, min(segments, total // DOWNLOAD_SEGMENT_MIN_SIZE))
+    step = -(-total // count)
+    return [_Segment(start, min(start + step, total) - 1) for start in range(0, total, step)]
+
+
+def _preallocate(path: str, total: int):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(fd, 0, total)
+        else:
+            os.ftruncate(fd, total)
+    except OSError:
+        # e.g. tmpfs without fallocate support
+        os.ftruncate(fd, total)
+    finally:
+        os.close(fd)
+
+
+def _retryable(e: Exception) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return isinstance(e, (httpx.TransportError, OSError))
+
+
+async def _backoff(attempt: int):
+    await asyncio.sleep(DOWNLOAD_BACKOFF * 2 ** attempt * (0.5 + random.random()))
+
+
+async def _fetch_segment(url: str, fd: int, segment: _Segment, headers: dict, timeout):
+    attempt = 0
+    while not segment.done:
+        try:
+            async with host_slot(url):
+                request_headers = {**headers, "Range": f"bytes={segment.offset}-{segment.end}"}
+                async with get_client().stream("GET", url, headers=request_headers, timeout=timeout) as resp:
+                    if resp.status_code == 200:
+                        raise RangeNotSupported(f"{url} ignored the Range header")
+                    resp.raise_for_status()
+                    async for chunk in resp.aiter_bytes(CHUNK_SIZE):
+                        chunk = chunk[:segment.end - segment.offset + 1]
+                        os.pwrite(fd, chunk, segment.offset)
+                        segment.offset += len(chunk)
+                        if segment.done:
+                            break
+            if not segment.done:
+                raise httpx.RemoteProtocolError("range response ended early")
+        except Exception as e:
+            attempt += 1
+            if not _retryable(e) or attempt > DOWNLOAD_RETRIES:
+                raise
+            logging.info(f"Segment {segment.start}-{segment.end} of {url} failed at {segment.offset} ({e}), retrying")
+            await _backoff(attempt)
+
+
+async def _probe(url: str, headers: dict, timeout) -> int | None:
+    """
+    Повний розмір файлу, якщо сервер підтримує Range (інакше None).
+    """
+    async with host_slot(url):
+        async with get_client().stream("GET", url, headers={**headers, "Range": "bytes=0-0"}, timeout=timeout) as resp:
+            resp.raise_for_status()
+            content_range = resp.headers.get("content-range", "")
+            if resp.status_code == 206 and "/" in content_range:
+                total = content_range.rsplit("/", 1)[1]
+                return int(total) if total.isdigit() else None
+    return None
+
+
+async def _single_stream(url: str, path: str, headers: dict, timeout) -> int:
+    attempt = 0
+    while True:
+        written = 0
+        try:
+            async with host_slot(url):
+                async with get_client().stream("GET", url, headers=headers, timeout=timeout) as resp:
+                    resp.raise_for_status()
+                    with open(path, "wb") as f:
+                        async for chunk in resp.aiter_bytes(CHUNK_SIZE):
+                            f.write(chunk)
+                            written += len(chunk)
+            return written
+        except Exception as e:
+            attempt += 1
+            if not _retryable(e) or attempt > DOWNLOAD_RETRIES:
+                raise
+            logging.info(f"Download of {url} failed after {written} bytes ({e}), retrying")
+            await _backoff(attempt)
+
+
+async def download_file(url: str, path: str, headers: dict | None = None, timeout=DOWNLOAD_TIMEOUT,
+                        segments: int = DOWNLOAD_SEGMENTS,
+                        on_size: Callable[[int | None], Awaitable[None]] | None = None) -> int:
+    """
+    Завантажує `url` у `path` паралельними діапазонами; повтор діапазону продовжує з останнього байта
+    (або одним потоком, якщо сервер не підтримує Range). Повертає кількість байтів.
+    `on_size(total)` викликається до того, як почнуть рухатися байти медіа.
+    """
+    headers = headers or {}
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    total = await _probe(url, headers, timeout)
+    if on_size:
+        await on_size(total)
+
+    if total:
+        try:
+            return await _download_ranges(url, path, total, headers, timeout, segments)
+        except RangeNotSupported as e:
+            logging.info(f"{e}, falling back to a single stream")
+
+    try:
+        return await _single_stream(url, path, headers, timeout)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+
+async def _download_ranges(url: str, path: str, total: int, headers: dict, timeout, segments: int) -> int:
+    part = path + ".part"
+    plan = _plan(total, segments)
+    _preallocate(part, total)
+
+    fd = os.open(part, os.O_WRONLY)
+    try:
+        tasks = [asyncio.create_task(_fetch_segment(url, fd, s, headers, timeout)) for s in plan]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            os.remove(part)
+            raise
+    finally:
+        os.close(fd)
+    os.replace(part, path)
+    return total
@@ -0,0 +1,205 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    SendAudio, SendDocument, SendMediaGroup, SendPhoto, SendVideo, SendMessage,
+)
+
+from services import metrics
+
+# Outbound pacing for Bot API calls that post into a chat. Telegram allows about
+# 30 messages per second overall, about one per second in a private chat and
+# about 20 per minute in a group; above that it answers 429 with retry_after.
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 30))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", 1))
+SEND_GROUP_PER_MINUTE = float(os.getenv("SEND_GROUP_PER_MINUTE", 20))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", 3))
+SEND_RETRIES = int(os.getenv("SEND_RETRIES", 5))
+
+# Finished media goes out first, status chatter ("⏳ ...", queue positions) last.
+PRIORITY_MEDIA = 0
+PRIORITY_MESSAGE = 1
+PRIORITY_STATUS = 2
+
+_MEDIA_METHODS = (SendVideo, SendAudio, SendMediaGroup, SendPhoto, SendDocument)
+
+
+class _Bucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def wait_time(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _Waiter:
+    __slots__ = ("chat_id", "future")
+
+    def __init__(self, chat_id, future: asyncio.Future):
+        self.chat_id = chat_id
+        self.future = future
+
+
+def _is_group(chat_id) -> bool:
+    if isinstance(chat_id, str):
+        return chat_id.startswith("@") or chat_id.startswith("-")
+    return chat_id < 0
+
+
+class OutboundLimiter:
+    """
+    Глобальний і по-чатовий token bucket з пріоритетною чергою.
+    Відправник, заблокований лімітом свого чату, не затримує відправки в інші чати.
+    """
+
+    def __init__(self, global_rate: float = SEND_GLOBAL_RATE, chat_rate: float = SEND_CHAT_RATE,
+                 group_per_minute: float = SEND_GROUP_PER_MINUTE, chat_burst: int = SEND_CHAT_BURST):
+        self.chat_rate = chat_rate
+        self.group_rate = group_per_minute / 60
+        self.chat_burst = chat_burst
+        self._global = _Bucket(global_rate, global_rate)
+        self._chats: dict[object, _Bucket] = {}
+        self._waiting: list[tuple[int, int, _Waiter]] = []
+        self._seq = itertools.count()
+        self._timer: asyncio.TimerHandle | None = None
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    def split(self, workers: int):
+        """
+        Залишає цьому процесу 1/`workers` глобального і групового лімітів. Приватний чат ділити
+        не треба: його апдейти завжди йдуть в один процес. Груповий ліміт так лише наближений.
+        """
+        global_rate = self._global.rate / workers
+        self._global = _Bucket(global_rate, global_rate)
+        self.group_rate /= workers
+        self._chats.clear()
+
+    def _bucket(self, chat_id) -> _Bucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            rate = self.group_rate if _is_group(chat_id) else self.chat_rate
+            bucket = self._chats[chat_id] = _Bucket(rate, self.chat_burst)
+        return bucket
+
+    async def acquire(self, chat_id, priority: int = PRIORITY_MESSAGE):
+        waiter = _Waiter(chat_id, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiting, (priority, next(self._seq), waiter))
+        self._dispatch()
+        try:
+            await waiter.future
+        finally:
+            # A cancelled waiter stays in the heap until _dispatch skips it.
+            waiter.future.cancel()
+
+    def retry_after(self, chat_id, seconds: float):
+        """
+        Telegram попросив зачекати: блокує чат (або все, якщо чат невідомий) на `seconds`.
+        """
+        bucket = self._bucket(chat_id) if chat_id is not None else self._global
+        bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + seconds)
+        bucket.tokens = 0
+        self._dispatch()
+
+    def _dispatch(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+        now = time.monotonic()
+        next_wake = None
+        remaining = []
+        while self._waiting:
+            entry = heapq.heappop(self._waiting)
+            waiter = entry[2]
+            if waiter.future.done():
+                continue
+            global_wait = self._global.wait_time(now)
+            chat_wait = self._bucket(waiter.chat_id).wait_time(now)
+            if global_wait or chat_wait:
+                remaining.append(entry)
+                wait = max(global_wait, chat_wait)
+                next_wake = wait if next_wake is None else min(next_wake, wait)
+                if global_wait:
+                    # Nobody can go before the global bucket refills.
+                    break
+                continue
+            self._global.take()
+            self._bucket(waiter.chat_id).take()
+            waiter.future.set_result(None)
+
+        for entry in remaining:
+            heapq.heappush(self._waiting, entry)
+        if self._waiting and next_wake is not None:
+            self._timer = asyncio.get_running_loop().call_later(next_wake, self._dispatch)
+
+        # Idle per-chat buckets are full again and carry no state worth keeping.
+        if len(self._chats) > 10000:
+            for chat_id, bucket in list(self._chats.items()):
+                if bucket.wait_time(now) == 0 and bucket.tokens >= bucket.capacity:
+                    del self._chats[chat_id]
+
+
+def method_priority(method) -> int:
+    if isinstance(method, _MEDIA_METHODS):
+        return PRIORITY_MEDIA
+    if isinstance(method, SendMessage):
+        return PRIORITY_MESSAGE
+    return PRIORITY_STATUS
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """
+    Пропускає кожен виклик Bot API з chat_id через OutboundLimiter і повторює його після 429,
+    тож вже завантажений файл не губиться через тимчасовий flood control.
+    """
+
+    def __init__(self, limiter: "OutboundLimiter | None" = None, retries: int = SEND_RETRIES):
+        self.limiter = limiter or outbound
+        self.retries = retries
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        priority = method_priority(method)
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            await self.limiter.acquire(chat_id, priority)
+            metrics.observe("ratelimit_wait", type(method).__name__, time.monotonic() - started)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                logging.warning(f"Flood control for chat {chat_id}: retry {type(method).__name__} "
+                                f"in {e.retry_after}s ({attempt}/{self.retries})")
+                self.limiter.retry_after(chat_id, e.retry_after)
+
+
+outbound = OutboundLimiter()
+metrics.gauge("downloader_send_queue_depth", "Bot API calls waiting for a send slot.", lambda: outbound.waiting)
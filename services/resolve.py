@@ -0,0 +1,53 @@
+import os
+from typing import Any, Awaitable, Callable
+
+from services import metrics
+from services.botapi import PATH_UPLOADS, LOCAL_UPLOAD_LIMIT_MB
+from services.cache import make_key
+from services.links import extract_media_id
+from services.singleflight import SingleFlight
+
+# Metadata (sizes, durations, direct URLs) is resolved before any media bytes
+# move, so oversized posts are rejected up front instead of after the download.
+MB = 1024 * 1024
+# A local Bot API server in --local mode accepts files up to 2000 MB instead of 50 MB.
+TELEGRAM_UPLOAD_LIMIT = int(os.getenv("TELEGRAM_UPLOAD_LIMIT_MB", LOCAL_UPLOAD_LIMIT_MB if PATH_UPLOADS else 50)) * MB
+MAX_MEDIA_DURATION = int(os.getenv("MAX_MEDIA_DURATION", 3 * 3600))
+# Direct media URLs are signed and expire, so resolve results are short-lived.
+RESOLVE_CACHE_TTL = int(os.getenv("RESOLVE_CACHE_TTL", 600))
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+def check_limits(size: int | None = None, duration: float | None = None):
+    """
+    Кидає MediaTooLarge, якщо відомий розмір або тривалість перевищують ліміти.
+    """
+    if size and size > TELEGRAM_UPLOAD_LIMIT:
+        raise MediaTooLarge(
+            f"❌ File is too big for Telegram ({size // MB} MB, limit {TELEGRAM_UPLOAD_LIMIT // MB} MB)."
+        )
+    if duration and MAX_MEDIA_DURATION and duration > MAX_MEDIA_DURATION:
+        raise MediaTooLarge(f"❌ Video is too long ({int(duration) // 60} min, limit {MAX_MEDIA_DURATION // 60} min).")
+
+
+def fits(size: int | None) -> bool:
+    return size is not None and size <= TELEGRAM_UPLOAD_LIMIT
+
+
+_resolves = SingleFlight()
+
+
+async def cached_resolve(platform: str, url: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Метадані для медіа `url`: один запит на всіх одночасних учасників, далі кеш на RESOLVE_CACHE_TTL.
+    Помилки не кешуються.
+    """
+    key = make_key(platform, extract_media_id(platform, url), "resolve")
+    async with _resolves.join(key, fetch, linger=RESOLVE_CACHE_TTL) as flight:
+        return flight.result
+
+
+metrics.gauge("downloader_resolve_cache_entries", "Cached metadata resolves.", _resolves.in_flight)
@@ -0,0 +1,142 @@
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+from aiogram.types import Message
+
+from services import metrics
+
+# Concurrency limits for download jobs (global, per platform, per user).
+JOBS_MAX_GLOBAL = int(os.getenv("JOBS_MAX_GLOBAL", 6))
+JOBS_MAX_PER_USER = int(os.getenv("JOBS_MAX_PER_USER", 2))
+JOBS_MAX_PER_PLATFORM = {
+    "youtube": int(os.getenv("JOBS_MAX_YOUTUBE", 2)),
+    "tiktok": int(os.getenv("JOBS_MAX_TIKTOK", 4)),
+    "instagram": int(os.getenv("JOBS_MAX_INSTAGRAM", 4)),
+}
+
+
+class _Job:
+    __slots__ = ("platform", "user_id", "started", "changed")
+
+    def __init__(self, platform: str, user_id: int | None):
+        self.platform = platform
+        self.user_id = user_id
+        self.started = False
+        self.changed = asyncio.Event()
+
+
+class JobScheduler:
+    """
+    FIFO-черга завантажень з глобальним, платформовим і користувацьким лімітами.
+    Задача, заблокована своїм лімітом, не затримує інші задачі за нею.
+    """
+
+    def __init__(self, max_global: int = JOBS_MAX_GLOBAL, max_per_user: int = JOBS_MAX_PER_USER,
+                 max_per_platform: dict[str, int] | None = None):
+        self.max_global = max_global
+        self.max_per_user = max_per_user
+        self.max_per_platform = max_per_platform or JOBS_MAX_PER_PLATFORM
+        self._waiting: list[_Job] = []
+        self._running = 0
+        self._per_platform: dict[str, int] = {}
+        self._per_user: dict[int, int] = {}
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    async def run(self, platform: str, user_id: int | None, factory: Callable[[], Awaitable[Any]],
+                  on_position: Callable[[int], Awaitable[None]] | None = None) -> Any:
+        """
+        Чекає на вільний слот і виконує `factory()`.
+        `on_position(n)` отримує позицію в черзі (n >= 1) і 0, коли задача стартує.
+        """
+        job = _Job(platform, user_id)
+        self._waiting.append(job)
+        self._dispatch()
+
+        try:
+            reported = None
+            while not job.started:
+                position = self._waiting.index(job) + 1
+                if on_position and position != reported:
+                    await on_position(position)
+                    reported = position
+                job.changed.clear()
+                if not job.started:
+                    await job.changed.wait()
+        except BaseException:
+            if job.started:
+                self._release(job)
+            else:
+                self._waiting.remove(job)
+                self._dispatch()
+            raise
+
+        try:
+            if on_position and reported is not None:
+                await on_position(0)
+            return await factory()
+        finally:
+            self._release(job)
+
+    def _can_start(self, job: _Job) -> bool:
+        if self._running >= self.max_global:
+            return False
+        if self._per_platform.get(job.platform, 0) >= self.max_per_platform.get(job.platform, self.max_global):
+            return False
+        if job.user_id is not None and self._per_user.get(job.user_id, 0) >= self.max_per_user:
+            return False
+        return True
+
+    def _dispatch(self):
+        for job in list(self._waiting):
+            if self._running >= self.max_global:
+                break
+            if not self._can_start(job):
+                continue
+            self._waiting.remove(job)
+            job.started = True
+            self._running += 1
+            self._per_platform[job.platform] = self._per_platform.get(job.platform, 0) + 1
+            if job.user_id is not None:
+                self._per_user[job.user_id] = self._per_user.get(job.user_id, 0) + 1
+            job.changed.set()
+
+        # Queue positions may have shifted for everyone still waiting.
+        for job in self._waiting:
+            job.changed.set()
+
+    def _release(self, job: _Job):
+        self._running -= 1
+        self._per_platform[job.platform] -= 1
+        if job.user_id is not None:
+            self._per_user[job.user_id] -= 1
+            if not self._per_user[job.user_id]:
+                del self._per_user[job.user_id]
+        self._dispatch()
+
+
+def queue_status(status: Message, downloading_text: str) -> Callable[[int], Awaitable[None]]:
+    """
+    Оновлює статус-повідомлення позицією в черзі замість статичного "⏳ Downloading...".
+    """
+    async def update(position: int):
+        text = f"🕒 You are #{position} in queue..." if position else downloading_text
+        try:
+            await status.edit_text(text)
+        except Exception as e:
+            logging.debug(f"Queue status update skipped: {e}")
+
+    return update
+
+
+scheduler = JobScheduler()
+metrics.gauge("downloader_queue_depth", "Jobs waiting for a download slot.", lambda: scheduler.waiting)
+metrics.gauge("downloader_jobs_running", "Download jobs in progress.", lambda: scheduler.running)
@@ -0,0 +1,146 @@
+import os
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable
+
+from services import metrics
+
+# How long a finished download stays on disk for follow-up requests (e.g. the MP3 button).
+DOWNLOAD_LINGER = int(os.getenv("DOWNLOAD_LINGER", 120))
+
+
+class Flight:
+    """
+    Один спільний виклик завантажувача для ключа медіа.
+    """
+    __slots__ = ("key", "future", "refs", "lock", "file_id", "expiry", "cleanup")
+
+    def __init__(self, key: str, future: asyncio.Future):
+        self.key = key
+        self.future = future
+        self.refs = 0
+        # Serializes sending so only the first waiter uploads the file and
+        # everyone after it resends by the returned file_id.
+        self.lock = asyncio.Lock()
+        self.file_id: str | None = None
+        self.expiry: asyncio.TimerHandle | None = None
+        self.cleanup: Callable[[Any], None] | None = None
+
+    @property
+    def result(self) -> Any:
+        return self.future.result()
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights: dict[str, Flight] = {}
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    @asynccontextmanager
+    async def join(self, key: str, factory: Callable[[], Awaitable[Any]],
+                   cleanup: Callable[[Any], None] | None = None, linger: float = 0):
+        """
+        Перший виклик для `key` запускає `factory()`, решта чекає на той самий результат.
+        `cleanup(result)` викликається після виходу останнього учасника
+        (або через `linger` секунд, якщо за цей час ніхто не приєднався).
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = Flight(key, asyncio.ensure_future(factory()))
+            self._flights[key] = flight
+        if flight.expiry is not None:
+            flight.expiry.cancel()
+            flight.expiry = None
+        flight.refs += 1
+
+        try:
+            # shield: a cancelled waiter must not cancel the download for the others
+            await asyncio.shield(flight.future)
+            yield flight
+        finally:
+            flight.refs -= 1
+            if flight.refs == 0:
+                self._linger(flight, cleanup, linger)
+
+    def peek(self, key: str) -> Any:
+        """
+        Готовий успішний результат для `key` без очікування (None, якщо його ще немає).
+        """
+        flight = self._flights.get(key)
+        if flight is None or not flight.future.done() or flight.future.cancelled():
+            return None
+        return None if flight.future.exception() is not None else flight.future.result()
+
+    def offer(self, key: str, result: Any, cleanup: Callable[[Any], None] | None = None,
+              linger: float = DOWNLOAD_LINGER) -> bool:
+        """
+        Кладе вже готовий результат під `key` на `linger` секунд, якщо для ключа ще немає виклику.
+        False — результат не взято, і викликач звільняє його сам.
+        """
+        if key in self._flights:
+            return False
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(result)
+        flight = Flight(key, future)
+        self._flights[key] = flight
+        self._linger(flight, cleanup, linger)
+        return True
+
+    def forget(self, key: str):
+        """
+        Не віддавати поточний результат новим учасникам (наприклад, якщо завантаження повернуло помилку).
+        """
+        self._flights.pop(key, None)
+
+    def expire_lingering(self):
+        """
+        Одразу звільняє всі результати, що чекають на повторне використання (коли бракує місця).
+        """
+        for flight in list(self._flights.values()):
+            if flight.expiry is not None and flight.refs == 0:
+                flight.expiry.cancel()
+                self._expire(flight, flight.cleanup)
+
+    def _linger(self, flight: Flight, cleanup, linger: float):
+        # Keep a successful result around for a while, e.g. so the MP3 button
+        # can reuse the video that was just sent instead of fetching it again.
+        future = flight.future
+        if (linger > 0 and self._flights.get(flight.key) is flight
+                and future.done() and not future.cancelled() and future.exception() is None):
+            loop = asyncio.get_running_loop()
+            flight.cleanup = cleanup
+            flight.expiry = loop.call_later(linger, self._expire, flight, cleanup)
+            return
+        self._release(flight, cleanup)
+
+    def _expire(self, flight: Flight, cleanup):
+        flight.expiry = None
+        if flight.refs == 0:
+            self._release(flight, cleanup)
+
+    def _release(self, flight: Flight, cleanup):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+        if cleanup is None:
+            return
+        if flight.future.done():
+            _run_cleanup(flight.future, cleanup)
+        else:
+            # Every waiter went away while the download was still running.
+            flight.future.add_done_callback(lambda f: _run_cleanup(f, cleanup))
+
+
+def _run_cleanup(future: asyncio.Future, cleanup):
+    if future.cancelled() or future.exception() is not None:
+        return
+    try:
+        cleanup(future.result())
+    except Exception as e:
+        logging.error(f"Single-flight cleanup failed: {e}")
+
+
+downloads = SingleFlight()
+metrics.gauge("downloader_flights", "Distinct media keys being downloaded or lingering.", downloads.in_flight)
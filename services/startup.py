@@ -0,0 +1,50 @@
+import os
+import sys
+import time
+import logging
+import resource
+import importlib
+from contextlib import contextmanager
+from types import ModuleType
+
+# Cold start matters because containers restart on every deploy. Each step
+# records its wall time and how many modules it pulled in; the report is one log record.
+STARTUP_REPORT = os.getenv("STARTUP_REPORT", "1") == "1"
+
+
+class StartupTimer:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.steps: list[tuple[str, float, int]] = []
+
+    @contextmanager
+    def step(self, name: str):
+        modules = len(sys.modules)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append((name, time.perf_counter() - started, len(sys.modules) - modules))
+
+    def import_module(self, name: str) -> ModuleType:
+        with self.step(f"import {name}"):
+            return importlib.import_module(name)
+
+    def report(self) -> str:
+        """
+        Час кожного кроку запуску, кількість нових модулів і пікова RSS.
+        """
+        lines = [f"{name:<32} {seconds * 1000:7.1f} ms  +{modules} modules"
+                 for name, seconds, modules in self.steps]
+        # ru_maxrss is KB on Linux
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        lines.append(f"{'total':<32} {(time.perf_counter() - self.started) * 1000:7.1f} ms  "
+                     f"{len(sys.modules)} modules, peak RSS {rss:.1f} MB")
+        return "\n".join(lines)
+
+    def log(self):
+        if STARTUP_REPORT:
+            logging.info("Startup timing:\n" + self.report())
+
+
+startup = StartupTimer()
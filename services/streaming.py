@@ -0,0 +1,157 @@
+import os
+import asyncio
+import logging
+from typing import Any, AsyncGenerator, Awaitable, Callable
+
+from aiogram.types import Message
+from aiogram.types.input_file import InputFile
+
+from services import probe
+from services.cache import file_cache
+from services.formats import playable
+from services.http import CHUNK_SIZE, get_client, host_slot
+from services.scheduler import scheduler
+from services.singleflight import downloads, DOWNLOAD_LINGER
+from services.workspace import Workspace, workspaces
+
+# Pipe direct progressive MP4s (TikTok, Instagram) from upstream straight into
+# the Telegram upload instead of going through services/downloads. When there is
+# room, the bytes are also copied into a workspace and left as the video flight,
+# so the MP3 button reuses them instead of downloading the video again.
+STREAM_UPLOADS = os.getenv("STREAM_UPLOADS", "1") == "1"
+STREAM_BUFFER_CHUNKS = int(os.getenv("STREAM_BUFFER_CHUNKS", 16))
+# A stream skips formats.prepare_video, so only a file whose head already shows
+# H.264/AAC with moov before mdat is streamed; anything else goes through the disk.
+STREAM_PROBE_BYTES = 512 * 1024
+
+
+class StreamInputFile(InputFile):
+    """
+    InputFile, що читає тіло HTTP-відповіді через невеликий обмежений буфер.
+    """
+
+    def __init__(self, url: str, filename: str = "video.mp4", chunk_size: int = CHUNK_SIZE,
+                 buffer_chunks: int = STREAM_BUFFER_CHUNKS, copy_to: Workspace | None = None):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.url = url
+        self.buffer_chunks = buffer_chunks
+        self.bytes_read = 0
+        self.copy_to = copy_to
+        # Set once the whole body has also been written into `copy_to`.
+        self.copy_path: str | None = None
+
+    def _open_copy(self, length: str | None):
+        # Only with a known size that fits right now: the upload never waits for disk space.
+        if self.copy_to is None or not length or not workspaces.try_admit(self.copy_to, int(length)):
+            return None
+        return open(self.copy_to.file(self.filename), "wb")
+
+    async def read(self, bot) -> AsyncGenerator[bytes, None]:
+        self.copy_path = None
+        buffer: asyncio.Queue = asyncio.Queue(maxsize=self.buffer_chunks)
+
+        async def produce():
+            try:
+                async with host_slot(self.url):
+                    async with get_client().stream("GET", self.url) as resp:
+                        resp.raise_for_status()
+                        copy = self._open_copy(resp.headers.get("content-length"))
+                        try:
+                            async for chunk in resp.aiter_bytes(self.chunk_size):
+                                if copy:
+                                    copy.write(chunk)
+                                await buffer.put(chunk)
+                        finally:
+                            if copy:
+                                copy.close()
+                        if copy:
+                            self.copy_path = copy.name
+                await buffer.put(None)
+            except Exception as e:
+                await buffer.put(e)
+
+        producer = asyncio.create_task(produce())
+        try:
+            while True:
+                item = await buffer.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                self.bytes_read += len(item)
+                yield item
+        finally:
+            producer.cancel()
+
+
+async def plays_inline(url: str) -> bool:
+    """
+    Чи Telegram відтворить файл за `url` одразу, як є: за першими STREAM_PROBE_BYTES байтами.
+    """
+    head = b""
+    try:
+        async with host_slot(url):
+            headers = {"Range": f"bytes=0-{STREAM_PROBE_BYTES - 1}"}
+            async with get_client().stream("GET", url, headers=headers) as resp:
+                resp.raise_for_status()
+                async for chunk in resp.aiter_bytes(CHUNK_SIZE):
+                    head += chunk
+                    if len(head) >= STREAM_PROBE_BYTES:
+                        break
+    except Exception as e:
+        logging.debug(f"Stream probe failed for {url}: {e}")
+        return False
+    media = probe.parse_head(head)
+    return media is not None and playable(media.vcodec, media.acodec)
+
+
+async def answer_video_streamed(message: Message, platform: str, cache_key: str,
+                                resolve: Callable[[], Awaitable[str | None]],
+                                keep_as: Callable[[str], Any] | None = None,
+                                cleanup: Callable[[Any], None] | None = None, **kwargs) -> Message | None:
+    """
+    Надсилає відео, передаючи байти з джерела напряму в Telegram.
+    Повертає None, якщо стрімінг недоступний або не вдався — тоді викликач іде звичайним шляхом через диск.
+    З `keep_as` копія відео лишається в `downloads` під `cache_key` як `keep_as(path)` (з `cleanup`),
+    як після звичайного завантаження.
+    """
+    if not STREAM_UPLOADS:
+        return None
+
+    async def resolve_playable() -> str | None:
+        media_url = await resolve()
+        return media_url if media_url and await plays_inline(media_url) else None
+
+    try:
+        async with downloads.join(f"{cache_key}:stream", resolve_playable) as flight:
+            media_url = flight.result
+            if not media_url:
+                downloads.forget(f"{cache_key}:stream")
+                return None
+
+            async with flight.lock:
+                if flight.file_id:
+                    return await message.answer_video(flight.file_id, **kwargs)
+
+                workspace = workspaces.open(platform) if keep_as else None
+                try:
+                    stream = StreamInputFile(media_url, copy_to=workspace)
+                    sent = await scheduler.run(
+                        platform, message.from_user.id if message.from_user else None,
+                        lambda: message.answer_video(stream, **kwargs)
+                    )
+                    if sent.video:
+                        flight.file_id = sent.video.file_id
+                        file_cache.put(cache_key, flight.file_id)
+                    if (workspace and stream.copy_path
+                            and downloads.offer(cache_key, keep_as(stream.copy_path), cleanup, DOWNLOAD_LINGER)):
+                        # The lingering flight releases the workspace now.
+                        workspace = None
+                finally:
+                    if workspace:
+                        workspaces.release(workspace)
+                return sent
+    except Exception as e:
+        logging.warning(f"Streamed upload failed for {cache_key}, falling back to disk: {e}")
+        downloads.forget(f"{cache_key}:stream")
+        return None
@@ -0,0 +1,67 @@
+import os
+import time
+import asyncio
+import logging
+
+from aiogram import Bot
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, Message
+
+# The bot's own username is needed for every caption; it is loaded once at
+# startup and refreshed in the background every BOT_INFO_TTL seconds.
+BOT_INFO_TTL = int(os.getenv("BOT_INFO_TTL", 6 * 3600))
+
+_username: str | None = None
+_loaded_at = 0.0
+_refresh: asyncio.Task | None = None
+
+
+async def load_bot_identity(bot: Bot) -> str:
+    global _username, _loaded_at
+    me = await bot.get_me()
+    _username = me.username
+    _loaded_at = time.monotonic()
+    return _username
+
+
+async def bot_username(bot: Bot) -> str:
+    global _refresh
+    if _username is None:
+        return await load_bot_identity(bot)
+    if time.monotonic() - _loaded_at > BOT_INFO_TTL and (_refresh is None or _refresh.done()):
+        _refresh = asyncio.create_task(load_bot_identity(bot))
+    return _username
+
+
+# ------------------------- CAPTIONS & KEYBOARDS -------------------------
+
+def video_caption(username: str) -> str:
+    return f"🔗 Download video here 👉 @{username}"
+
+
+def audio_caption(username: str) -> str:
+    return f"🔗 Download audio here 👉 @{username}"
+
+
+def photos_caption(username: str) -> str:
+    return f"📸 Download photos here 👉 @{username}"
+
+
+def mp3_keyboard(callback_prefix: str, token: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🎵 Download in MP3", callback_data=f"{callback_prefix}|{token}")]
+    ])
+
+
+async def finish_status(status: Message | None, error: str | None = None):
+    """
+    Прибирає статус "⏳ ..." після відповіді або замінює його текстом помилки (без нового повідомлення).
+    """
+    if status is None:
+        return
+    try:
+        if error:
+            await status.edit_text(error)
+        else:
+            await status.delete()
+    except Exception as e:
+        logging.debug(f"Status message update skipped: {e}")
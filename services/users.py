@@ -0,0 +1,184 @@
+import os
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, NamedTuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User
+
+from services import metrics
+from services.dp import DB_PATH
+
+# User activity is written behind on a dedicated DB thread: every update only
+# touches memory, and pending rows are group-committed every USERS_FLUSH_MS.
+USERS_FLUSH_MS = int(os.getenv("USERS_FLUSH_MS", 250))
+
+_UPSERT = (
+    "INSERT INTO users (user_id, first_name, last_name, chat_id, last_seen, requests) "
+    "VALUES (?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET "
+    "first_name = excluded.first_name, last_name = excluded.last_name, "
+    "chat_id = COALESCE(excluded.chat_id, users.chat_id), "
+    "last_seen = excluded.last_seen, requests = COALESCE(users.requests, 0) + excluded.requests"
+)
+
+
+class UserStats(NamedTuple):
+    requests: int
+    last_seen: float | None
+
+
+class _Pending:
+    __slots__ = ("first_name", "last_name", "chat_id", "last_seen", "requests")
+
+    def __init__(self):
+        self.requests = 0
+
+
+class UserRepository:
+    """
+    Користувачі бота без блокування event loop: SQLite лише в окремому потоці,
+    відомі користувачі — в пам'яті, записи збираються в пакет і комітяться разом.
+    """
+
+    def __init__(self, path: str = DB_PATH, flush_ms: int = USERS_FLUSH_MS):
+        self.path = path
+        self.flush_interval = flush_ms / 1000
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="users-db")
+        self._local = threading.local()
+        self._seen: set[int] = set()
+        self._pending: dict[int, _Pending] = {}
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._writing: set[asyncio.Future] = set()
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    # ------------------------- DB THREAD -------------------------
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # WAL + NORMAL: a commit does not wait for fsync, a crash loses at most the last batch.
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _exists(self, user_id: int) -> bool:
+        return self._conn().execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+    def _stats(self, user_id: int) -> UserStats | None:
+        row = self._conn().execute(
+            "SELECT COALESCE(requests, 0), last_seen FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return UserStats(*row) if row else None
+
+    def _write(self, rows: list[tuple]):
+        conn = self._conn()
+        with conn:
+            conn.executemany(_UPSERT, rows)
+
+    def _close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    async def _run(self, fn: Callable, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    # ------------------------- API -------------------------
+
+    async def record(self, user: User, chat_id: int | None = None, requests: int = 1) -> bool:
+        """
+        Оновлює імена, чат, last_seen і лічильник запитів користувача.
+        Повертає True, якщо користувача ще не було в базі.
+        """
+        pending = self._pending.get(user.id)
+        if pending is None:
+            pending = self._pending[user.id] = _Pending()
+        pending.first_name = user.first_name or ""
+        pending.last_name = user.last_name or ""
+        pending.chat_id = chat_id
+        pending.last_seen = time.time()
+        pending.requests += requests
+        self._schedule_flush()
+
+        if user.id in self._seen:
+            return False
+        # Added before the lookup so a burst from a new user is greeted as new only once.
+        self._seen.add(user.id)
+        try:
+            return not await self._run(self._exists, user.id)
+        except Exception as e:
+            logging.error(f"User lookup failed for {user.id}: {e}")
+            return False
+
+    async def stats(self, user_id: int) -> UserStats | None:
+        """
+        Кількість запитів і час останньої активності (з урахуванням ще не записаних змін).
+        """
+        stored = await self._run(self._stats, user_id)
+        pending = self._pending.get(user_id)
+        if pending is None:
+            return stored
+        return UserStats((stored.requests if stored else 0) + pending.requests, pending.last_seen)
+
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+
+    def flush(self) -> asyncio.Future | None:
+        self._flush_handle = None
+        if not self._pending:
+            return None
+        rows = [(user_id, p.first_name, p.last_name, p.chat_id, p.last_seen, p.requests)
+                for user_id, p in self._pending.items()]
+        self._pending = {}
+        future = asyncio.get_running_loop().run_in_executor(self._executor, self._write, rows)
+        self._writing.add(future)
+        future.add_done_callback(self._written)
+        return future
+
+    def _written(self, future: asyncio.Future):
+        self._writing.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            logging.error(f"User store flush failed: {future.exception()}")
+
+    async def close(self):
+        if self._flush_handle:
+            self._flush_handle.cancel()
+        self.flush()
+        if self._writing:
+            await asyncio.gather(*self._writing, return_exceptions=True)
+        await self._run(self._close)
+        self._executor.shutdown(wait=True)
+
+
+class UserActivityMiddleware(BaseMiddleware):
+    """
+    Рахує повідомлення й натискання кнопок кожного користувача; передає `new_user` у хендлер.
+    """
+
+    def __init__(self, repository: "UserRepository | None" = None):
+        self.repository = repository or users
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        user = data.get("event_from_user")
+        chat = data.get("event_chat")
+        if user is not None:
+            data["new_user"] = await self.repository.record(user, chat.id if chat else None)
+        return await handler(event, data)
+
+
+users = UserRepository()
+metrics.gauge("downloader_user_writes_pending", "User activity rows waiting for the next commit.",
+              lambda: users.pending)
@@ -20,4 +20,22 @@ def escape_markdown(text, version=2):
     escape_chars = r'_*[]()~`>#+-=|{}.!'
     if version == 2:
         escape_chars += r'\\'
-    return ''.join(f'\\{char}' if char in escape_chars else char for char in text)
\ No newline at end of file
+    return ''.join(f'\\{char}' if char in escape_chars else char for char in text)
+
+def remove_files(paths):
+    """
+    Видаляє файл або список файлів (разом з порожньою папкою слайдшоу).
+    """
+    if not paths:
+        return
+    if isinstance(paths, str):
+        if os.path.exists(paths):
+            os.remove(paths)
+        return
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+    try:
+        os.rmdir(os.path.dirname(paths[0]))
+    except OSError:
+        pass
@@ -0,0 +1,205 @@
+import os
+import signal
+import asyncio
+import logging
+import multiprocessing as mp
+
+from aiohttp import web
+
+# Webhook entry point. Updates are received by one aiohttp front process and
+# handed to WEBHOOK_WORKERS processes by user id, so one busy worker (ffmpeg,
+# large downloads) cannot stall update intake for users routed to the others.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 1))
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", 60))
+
+_USER_KEYS = (
+    "message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+    "my_chat_member", "chat_member", "chat_join_request", "pre_checkout_query", "shipping_query",
+)
+
+
+def update_user_id(update: dict) -> int:
+    for key in _USER_KEYS:
+        event = update.get(key)
+        if not event:
+            continue
+        user = event.get("from") or event.get("chat") or {}
+        if user.get("id") is not None:
+            return int(user["id"])
+    return int(update.get("update_id", 0))
+
+
+# ------------------------- UPDATE FEEDING -------------------------
+
+class _UpdateFeeder:
+    """
+    Передає сирі апдейти в Dispatcher і відстежує задачі, щоб дочекатися їх при зупинці.
+    """
+
+    def __init__(self, context):
+        context.include_handlers()
+        self.bot = context.bot
+        self.dp = context.dp
+        self._tasks: set[asyncio.Task] = set()
+        self._metrics_runner = None
+
+    async def start(self, metrics_port: int):
+        from services.metrics import start_metrics_server
+        from services.startup import startup
+        from services.ui import load_bot_identity
+        from services.workspace import workspaces
+
+        await load_bot_identity(self.bot)
+        workspaces.start_janitor()
+        self._metrics_runner = await start_metrics_server(port=metrics_port)
+        startup.log()
+
+    def feed(self, update: dict):
+        task = asyncio.create_task(self.dp.feed_raw_update(self.bot, update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def drain(self, timeout: float = DRAIN_TIMEOUT):
+        from services.cache import file_cache
+        from services.callbacks import callback_store
+        from services.http import close_clients
+        from services.users import users
+        from services.workspace import workspaces
+
+        if self._tasks:
+            logging.info(f"Draining {len(self._tasks)} in-flight updates...")
+            done, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+            for task in pending:
+                task.cancel()
+        await callback_store.close()
+        await file_cache.close()
+        await users.close()
+        workspaces.stop_janitor()
+        await close_clients()
+        await self.bot.session.close()
+        if self._metrics_runner:
+            await self._metrics_runner.cleanup()
+
+
+def _worker_main(index: int, queue: mp.Queue):
+    # Ctrl+C reaches the whole process group; workers stop on the sentinel instead.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO, format=f"[worker {index}] %(levelname)s %(message)s")
+    asyncio.run(_worker(index, queue))
+
+
+def _share_limits(workers: int):
+    from services.ratelimit import outbound
+    from services.scheduler import scheduler
+    from services.workspace import workspaces
+
+    # Workers share one workspace root, one host and one bot token, so the global limits
+    # are split between them. Per-user limits stay whole: a user is always routed to the
+    # same worker. Group chats are not, so each worker paces its share of a group's budget.
+    outbound.split(workers)
+    workspaces.quota //= workers
+    scheduler.max_global = max(1, scheduler.max_global // workers)
+    scheduler.max_per_platform = {
+        platform: max(1, limit // workers) for platform, limit in scheduler.max_per_platform.items()
+    }
+
+
+async def _worker(index: int, queue: mp.Queue):
+    from services.app import create_app
+    from services.metrics import METRICS_PORT
+
+    # A spawned worker is a fresh interpreter with its own Bot and Dispatcher.
+    feeder = _UpdateFeeder(create_app())
+    _share_limits(WEBHOOK_WORKERS)
+    # Each worker exposes its own /metrics on the next port after the front's.
+    await feeder.start(METRICS_PORT + 1 + index if METRICS_PORT else 0)
+    loop = asyncio.get_running_loop()
+    while True:
+        update = await loop.run_in_executor(None, queue.get)
+        if update is None:
+            break
+        feeder.feed(update)
+    await feeder.drain()
+
+
+# ------------------------- FRONT PROCESS -------------------------
+
+async def _handle_update(request: web.Request) -> web.Response:
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=401)
+    state = request.app["state"]
+    if state["draining"]:
+        # Telegram retries non-2xx responses, so nothing is lost during a restart.
+        return web.Response(status=503)
+
+    update = await request.json()
+    queues = state["queues"]
+    if queues:
+        queues[update_user_id(update) % len(queues)].put(update)
+    else:
+        state["feeder"].feed(update)
+    return web.Response()
+
+
+async def _on_startup(app: web.Application):
+    from services.workspace import workspaces
+
+    # No worker is running yet, so anything left in the workspace root is from a previous run.
+    workspaces.sweep(max_age=0)
+    state = app["state"]
+    if WEBHOOK_WORKERS > 1:
+        ctx = mp.get_context("spawn")
+        for index in range(WEBHOOK_WORKERS):
+            queue = ctx.Queue()
+            process = ctx.Process(target=_worker_main, args=(index, queue), daemon=False)
+            process.start()
+            state["queues"].append(queue)
+            state["workers"].append(process)
+        logging.info(f"Started {WEBHOOK_WORKERS} webhook workers.")
+    else:
+        from services.metrics import METRICS_PORT
+        state["feeder"] = _UpdateFeeder(state["context"])
+        await state["feeder"].start(METRICS_PORT)
+
+    await state["context"].bot.set_webhook(
+        f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET or None,
+        drop_pending_updates=False,
+    )
+
+
+async def _on_shutdown(app: web.Application):
+    state = app["state"]
+    state["draining"] = True
+    if state["workers"]:
+        for queue in state["queues"]:
+            queue.put(None)
+        loop = asyncio.get_running_loop()
+        for process in state["workers"]:
+            await loop.run_in_executor(None, process.join, DRAIN_TIMEOUT)
+            if process.is_alive():
+                logging.warning(f"Worker {process.pid} did not drain in time, terminating.")
+                process.terminate()
+        await state["context"].bot.session.close()
+    else:
+        await state["feeder"].drain()
+
+
+def run_webhook(context):
+    """
+    `context` — services.app.App процесу; з кількома воркерами він лише реєструє вебхук.
+    """
+    if not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL is required for webhook mode")
+
+    app = web.Application()
+    app["state"] = {"context": context, "queues": [], "workers": [], "feeder": None, "draining": False}
+    app.router.add_post(WEBHOOK_PATH, _handle_update)
+    app.on_startup.append(_on_startup)
+    app.on_shutdown.append(_on_shutdown)
+    web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT)
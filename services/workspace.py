@@ -0,0 +1,245 @@
+import os
+import time
+import uuid
+import shutil
+import asyncio
+import logging
+from typing import Callable
+
+from services import metrics
+from services.botapi import PATH_UPLOADS
+from services.singleflight import downloads
+from services.utils import DOWNLOADS_FOLDER, remove_files
+
+# Every download gets its own directory under WORKSPACE_ROOT. By default that is
+# tmpfs (/dev/shm) when it has room for the whole quota, otherwise services/downloads.
+# When a local Bot API server reads files by path they must stay on the volume it shares
+# with the bot; a server in another container cannot see this container's /dev/shm.
+MB = 1024 * 1024
+WORKSPACE_ROOT = os.getenv("WORKSPACE_ROOT", "")
+WORKSPACE_TMPFS = os.getenv("WORKSPACE_TMPFS", "1") == "1"
+WORKSPACE_QUOTA = int(os.getenv("WORKSPACE_QUOTA_MB", 2048)) * MB
+# Reserved for a download whose size is not known in advance.
+WORKSPACE_DEFAULT_RESERVE = int(os.getenv("WORKSPACE_DEFAULT_RESERVE_MB", 64)) * MB
+WORKSPACE_ADMIT_TIMEOUT = float(os.getenv("WORKSPACE_ADMIT_TIMEOUT", 300))
+WORKSPACE_MAX_AGE = int(os.getenv("WORKSPACE_MAX_AGE", 1800))
+WORKSPACE_JANITOR_INTERVAL = int(os.getenv("WORKSPACE_JANITOR_INTERVAL", 300))
+
+_TMPFS_DIR = "/dev/shm"
+
+
+class WorkspaceFull(Exception):
+    pass
+
+
+def default_root() -> str:
+    if WORKSPACE_ROOT:
+        return WORKSPACE_ROOT
+    if WORKSPACE_TMPFS and not PATH_UPLOADS and os.path.isdir(_TMPFS_DIR) and os.access(_TMPFS_DIR, os.W_OK):
+        if shutil.disk_usage(_TMPFS_DIR).free >= WORKSPACE_QUOTA:
+            return os.path.join(_TMPFS_DIR, "downloaderbot")
+    return DOWNLOADS_FOLDER
+
+
+class Workspace:
+    """
+    Тимчасова папка однієї задачі. Видаляється разом з вмістом, коли звільнено останнє посилання.
+    """
+    __slots__ = ("path", "refs", "reserved")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.refs = 1
+        self.reserved = 0
+
+    def file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+
+class WorkspaceManager:
+    """
+    Видає папки задач, тримає глобальну квоту байтів і прибирає покинуті папки.
+    """
+
+    def __init__(self, root: str | None = None, quota: int = WORKSPACE_QUOTA):
+        self.root = root or default_root()
+        self.quota = quota
+        self._active: dict[str, Workspace] = {}
+        self._reserved = 0
+        self._changed = asyncio.Event()
+        self._janitor: asyncio.Task | None = None
+        # Called when a download does not fit, e.g. to drop lingering results early.
+        self.on_pressure: list[Callable[[], None]] = []
+
+    @property
+    def active(self) -> int:
+        return len(self._active)
+
+    @property
+    def reserved(self) -> int:
+        return self._reserved
+
+    def open(self, prefix: str = "job") -> Workspace:
+        path = os.path.join(self.root, f"{prefix}-{uuid.uuid4().hex}")
+        os.makedirs(path)
+        workspace = Workspace(path)
+        self._active[path] = workspace
+        return workspace
+
+    async def admit(self, workspace: Workspace, nbytes: int | None = None):
+        """
+        Резервує до `nbytes` під файли задачі. Чекає, поки інші задачі звільнять місце,
+        і кидає WorkspaceFull, якщо файл більший за квоту або місця так і не стало.
+        """
+        nbytes = nbytes or WORKSPACE_DEFAULT_RESERVE
+        extra = nbytes - workspace.reserved
+        if extra <= 0:
+            return
+        if nbytes > self.quota:
+            raise WorkspaceFull(f"❌ File is too large ({nbytes // MB} MB).")
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + WORKSPACE_ADMIT_TIMEOUT
+        while not self._fits(extra):
+            for callback in self.on_pressure:
+                callback()
+            if self._fits(extra):
+                break
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise WorkspaceFull("❌ The server is busy, try again later.")
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                raise WorkspaceFull("❌ The server is busy, try again later.")
+
+        workspace.reserved += extra
+        self._reserved += extra
+
+    def try_admit(self, workspace: Workspace, nbytes: int) -> bool:
+        """
+        Як `admit`, але без очікування: False, якщо місця зараз немає.
+        """
+        extra = nbytes - workspace.reserved
+        if extra <= 0:
+            return True
+        if nbytes > self.quota or not self._fits(extra):
+            return False
+        workspace.reserved += extra
+        self._reserved += extra
+        return True
+
+    def _fits(self, nbytes: int) -> bool:
+        if self._reserved + nbytes > self.quota:
+            return False
+        return shutil.disk_usage(self.root).free >= nbytes
+
+    def _find(self, target) -> Workspace | None:
+        if isinstance(target, Workspace):
+            return target
+        if isinstance(target, (list, tuple)):
+            target = target[0] if target else None
+        path = target
+        while path and path not in self._active:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+        return self._active.get(path) if path else None
+
+    def retain(self, target) -> Workspace | None:
+        """
+        Ще одне посилання на папку, в якій лежить `target` (наприклад, MP3 поруч з відео).
+        """
+        workspace = self._find(target)
+        if workspace:
+            workspace.refs += 1
+        return workspace
+
+    def release(self, target):
+        """
+        Звільняє посилання на папку `target` (Workspace, шлях у ній або список шляхів).
+        """
+        if not target:
+            return
+        workspace = self._find(target)
+        if workspace is None:
+            # A file from before workspaces (or the root itself): plain delete.
+            remove_files(target)
+            return
+        workspace.refs -= 1
+        if workspace.refs > 0:
+            return
+        del self._active[workspace.path]
+        shutil.rmtree(workspace.path, ignore_errors=True)
+        self._reserved -= workspace.reserved
+        self._changed.set()
+
+    # ------------------------- JANITOR -------------------------
+
+    def sweep(self, max_age: float = WORKSPACE_MAX_AGE) -> int:
+        """
+        Видаляє папки й файли, яких не тримає жодна задача і які не змінювались `max_age` секунд.
+        """
+        now = time.time()
+        removed = 0
+        roots = {self.root, DOWNLOADS_FOLDER}
+        for root in roots:
+            if not os.path.isdir(root):
+                continue
+            for entry in os.scandir(root):
+                if entry.path in self._active or entry.path in roots:
+                    continue
+                try:
+                    if now - _last_modified(entry) < max_age:
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    else:
+                        os.remove(entry.path)
+                    removed += 1
+                except OSError as e:
+                    logging.debug(f"Janitor skipped {entry.path}: {e}")
+        if removed:
+            logging.info(f"Janitor removed {removed} orphaned download(s).")
+        return removed
+
+    def start_janitor(self, startup_max_age: float = WORKSPACE_MAX_AGE):
+        """
+        Прибирає залишки після падіння одразу, а далі періодично.
+        `startup_max_age=0`, коли жоден інший процес не може зараз використовувати ці папки.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        self.sweep(startup_max_age)
+        if self._janitor is None or self._janitor.done():
+            self._janitor = asyncio.create_task(self._run_janitor())
+
+    async def _run_janitor(self):
+        while True:
+            await asyncio.sleep(WORKSPACE_JANITOR_INTERVAL)
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.error(f"Janitor failed: {e}")
+
+    def stop_janitor(self):
+        if self._janitor:
+            self._janitor.cancel()
+            self._janitor = None
+
+
+def _last_modified(entry: os.DirEntry) -> float:
+    # A directory's own mtime does not change while a file inside it is written.
+    latest = entry.stat(follow_symlinks=False).st_mtime
+    if entry.is_dir(follow_symlinks=False):
+        for child in os.scandir(entry.path):
+            latest = max(latest, child.stat(follow_symlinks=False).st_mtime)
+    return latest
+
+
+workspaces = WorkspaceManager()
+workspaces.on_pressure.append(downloads.expire_lingering)
+metrics.gauge("downloader_workspaces", "Job directories currently held.", lambda: workspaces.active)
+metrics.gauge("downloader_workspace_reserved_bytes", "Bytes reserved against WORKSPACE_QUOTA_MB.",
+              lambda: workspaces.reserved)
@@ -0,0 +1,27 @@
+from services.providers import run_blocking
+
+# yt-dlp loads its whole extractor registry on import, so it is imported on first use.
+YDL_QUIET_OPTS = {"quiet": True, "no_warnings": True}
+
+
+def youtube_dl(opts: dict):
+    from yt_dlp import YoutubeDL
+    return YoutubeDL(opts)
+
+
+def _extract(url: str, opts: dict) -> dict:
+    with youtube_dl({**YDL_QUIET_OPTS, **opts}) as ydl:
+        info = ydl.extract_info(url, download=False)
+        if info.get("url"):
+            # Signed CDN links (TikTok) only work with the cookies set during extraction.
+            cookie = ydl.cookiejar.get_cookie_header(info["url"])
+            info["http_headers"] = {**(info.get("http_headers") or {}), **({"Cookie": cookie} if cookie else {})}
+        return info
+
+
+async def extract_info(url: str, **opts) -> dict:
+    """
+    Метадані yt-dlp без завантаження (у пулі потоків бекендів). Для вибраного формату `http_headers`
+    містить усе, що потрібно для прямого завантаження `info["url"]`.
+    """
+    return await run_blocking(_extract, url, opts)